@@ -1,6 +1,14 @@
 ﻿from collections import OrderedDict
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from queue import Empty, Full, Queue
+import random
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 # Author: Ruslana Kruk
@@ -10,49 +18,281 @@ from tqdm import tqdm
 from scrape_authorize import run_authorization
 from scrape_authorize_creators import authorize_creator_01_lina, authorize_creator_02_bad_liz, \
     authorize_creator_03_young_mary, authorize_creator_04_princess, authorize_creator_05_anotherblonde
-from scrape_mongo_writers import write_activity_to_mongo
+from scrape_mongo_writers import write_activity_to_mongo, read_checkpoint, save_checkpoint_progress, complete_checkpoint
 
 # URL for activity scraping
 activity_api_url = "enter_activity_api_url"  # The API URL for scraping activities
 
-# Request and process activity data by limit
-def request_by_limit(step_name, account_id, url_params, headers, offset_start, limit_size, rows_to_scan, days_to_scan):
+# Number of accounts scraped at the same time
+scrape_concurrency = 5
+
+# Number of pages fetched ahead while the current page is written (0 disables prefetch)
+prefetch_pages = 1
+
+# Adaptive page size bounds and retry settings
+min_limit_size, max_limit_size = 10, 200
+target_latency = 1.0  # Seconds per request above which the page size shrinks
+max_retries = 6
+backoff_base, backoff_cap = 0.5, 60.0
+retry_after_cap = backoff_cap  # Longest Retry-After wait honoured, in seconds
+retry_status_codes = {429, 500, 502, 503, 504}
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf")]
+
+# Create an HTTP session with a connection pool, reused for every page of one account
+def create_http_session(pool_size=2):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), capped at cap, or None
+def parse_retry_after(value, cap=retry_after_cap):
+    if not value:
+        return None
+    try:
+        return min(cap, max(0.0, float(value)))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return min(cap, max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds()))
+
+# Fetches pages with a page size that grows while the API is fast and error free and shrinks on slow or
+# failed responses. Throttled and 5xx responses are retried with jittered exponential backoff that honours Retry-After.
+# A short page at a size no full page has been returned for is taken as the API's page size cap, not the end of data.
+class AdaptivePageFetcher:
+    def __init__(self, session, api_url, url_params, headers, limit_size, adaptive=True):
+        self.session, self.api_url, self.url_params, self.headers = session, api_url, url_params, headers
+        self.limit = limit_size
+        self.min_limit, self.max_limit = (min(min_limit_size, limit_size), max(max_limit_size, limit_size)) if adaptive else (limit_size, limit_size)
+        self.success_streak = 0
+        self.proven_limit = 0  # Largest page size the API has returned a full page for
+        self.latency_counts = [0] * len(latency_buckets)
+        self.requests, self.retries, self.rows = 0, 0, 0
+        self.started = time.perf_counter()
+
+    def record_latency(self, latency):
+        self.requests += 1
+        self.latency_counts[bisect_left(latency_buckets, latency)] += 1
+
+    def grow(self, latency):
+        self.success_streak += 1
+        if latency > target_latency:
+            self.limit = max(self.min_limit, int(self.limit * 0.7))
+            self.success_streak = 0
+        elif latency < target_latency / 2 and self.success_streak >= 3:
+            self.limit = min(self.max_limit, int(self.limit * 1.5))
+            self.success_streak = 0
+
+    def shrink(self):
+        self.limit = max(self.min_limit, self.limit // 2)
+        self.success_streak = 0
+
+    # True when a page ends the data: it is empty, or short at a size a full page was already returned for.
+    # A short page at a larger size clamps the page size to the number of rows the API returned.
+    def is_last_page(self, documents, limit):
+        if not documents:
+            return True
+        if len(documents) >= limit:
+            self.proven_limit = max(self.proven_limit, limit)
+            return False
+        if limit <= self.proven_limit:
+            return True
+        self.max_limit = max(self.min_limit, len(documents))
+        self.limit = min(self.limit, self.max_limit)
+        return False
+
+    # Fetch the page at offset; returns (response, documents, limit) and documents is None when the request failed.
+    # Waits between retries end early once stop_event is set, and the page is then returned as failed.
+    def fetch(self, offset, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        for attempt in range(max_retries + 1):
+            limit = self.limit
+            start_time = time.perf_counter()
+            try:
+                response = self.session.get(self.api_url, params={"offset": offset, "limit": limit, **self.url_params}, headers=self.headers)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == max_retries:
+                    raise
+                response = None
+            latency = time.perf_counter() - start_time
+            self.record_latency(latency)
+
+            if response is not None and response.status_code == 200:
+                documents = response.json()
+                self.rows += len(documents)
+                self.grow(latency)
+                return response, documents, limit
+            if response is not None and response.status_code not in retry_status_codes or attempt == max_retries:
+                return response, None, limit
+
+            self.shrink()
+            self.retries += 1
+            delay = random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+            retry_after = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+            if stop_event.wait(max(delay, retry_after or 0)):
+                return response, None, limit
+
+    # Approximate latency percentile from the histogram, as the upper bound of the matching bucket
+    def latency_percentile(self, percentile):
+        threshold, seen = self.requests * percentile / 100, 0
+        for bucket, count in zip(latency_buckets, self.latency_counts):
+            seen += count
+            if count and seen >= threshold:
+                return bucket
+        return 0.0
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return (f"Requests: {self.requests} | Retries: {self.retries} | Limit: {self.limit} | "
+                f"p50 <= {self.latency_percentile(50)}s | p95 <= {self.latency_percentile(95)}s | "
+                f"p99 <= {self.latency_percentile(99)}s | Rows/sec: {self.rows / elapsed if elapsed else 0:.1f}")
+
+# Put an item into the queue, giving up once the consumer has stopped
+def put_unless_stopped(page_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            page_queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
+
+# Yield (offset, rows_scanned, response, documents, limit, last_page) pages, fetching up to prefetch_size pages ahead in a
+# producer thread. Offsets advance by the rows returned. The producer stops by itself after a failed or last page;
+# closing the generator stops it and discards prefetched pages.
+def iterate_pages(fetcher, offset_start, rows_to_scan, prefetch_size):
+    if prefetch_size <= 0:
+        offset, rows_scanned = offset_start, 0
+        while rows_scanned < rows_to_scan:
+            response, documents, limit = fetcher.fetch(offset)
+            last_page = documents is not None and fetcher.is_last_page(documents, limit)
+            offset += len(documents or [])
+            rows_scanned += len(documents or [])
+            yield offset, rows_scanned, response, documents, limit, last_page
+            if documents is None or last_page:
+                return
+        return
+
+    page_queue, stop_event = Queue(maxsize=prefetch_size), threading.Event()
+
+    def produce_pages():
+        offset, rows_scanned = offset_start, 0
+        try:
+            while rows_scanned < rows_to_scan and not stop_event.is_set():
+                response, documents, limit = fetcher.fetch(offset, stop_event)
+                last_page = documents is not None and fetcher.is_last_page(documents, limit)
+                offset += len(documents or [])
+                rows_scanned += len(documents or [])
+                if not put_unless_stopped(page_queue, (offset, rows_scanned, response, documents, limit, last_page), stop_event):
+                    break
+                if documents is None or last_page:
+                    break
+        except Exception as e:
+            put_unless_stopped(page_queue, e, stop_event)
+        finally:
+            put_unless_stopped(page_queue, None, stop_event)
+
+    producer = threading.Thread(target=produce_pages, daemon=True)
+    producer.start()
+    try:
+        while True:
+            page = page_queue.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stop_event.set()
+        while True:
+            try:
+                page_queue.get_nowait()
+            except Empty:
+                break
+        producer.join()
+
+# Request and process activity data by limit.
+# With checkpoint_endpoint set, a crashed run resumes from its last committed offset and the scan
+# stops at the high-water mark of the last completed run instead of walking back days_to_scan days.
+def request_by_limit(step_name, account_id, url_params, headers, offset_start, limit_size, rows_to_scan, days_to_scan,
+                     session=None, api_url=None, position=None, prefetch_size=prefetch_pages, checkpoint_endpoint=None,
+                     adaptive=True):
+    fetcher = AdaptivePageFetcher(session or requests, api_url or activity_api_url, url_params, headers, limit_size, adaptive)
+    high_water_mark = run_high_water_mark = None
+    if checkpoint_endpoint:
+        checkpoint = read_checkpoint(account_id, checkpoint_endpoint) or {}
+        high_water_mark = checkpoint.get("high_water_mark")
+        if checkpoint.get("status") == "running":
+            offset_start = checkpoint.get("offset", offset_start)
+            run_high_water_mark = checkpoint.get("run_high_water_mark")
     rows_scanned, offset, limit = 0, offset_start, limit_size
+    # Set only when the page loop ends normally, so an interrupted run never promotes its high-water mark
+    completed = False
     fs_counters = OrderedDict([('Total', 0), ('Inserted', 0), ('Updated', 0), ('Unchanged', 0),
                                ('User Inserted', 0), ('User Updated', 0)])
     progress_desc_mask = "Scrape {step_name} | Limit: {limit} | Offset: {offset} | Rows: {rows}"
     progress_bar = tqdm(total=rows_to_scan // limit, desc=progress_desc_mask.format(step_name=step_name, limit=limit, offset=offset, rows=rows_scanned),
-                        postfix=fs_counters, leave=True, smoothing=0.3)
+                        postfix=fs_counters, leave=True, smoothing=0.3, position=position)
 
-    while rows_scanned < rows_to_scan:
-        response = requests.get(activity_api_url, params={"offset": offset, "limit": limit, **url_params}, headers=headers)
-        offset += limit
-        rows_scanned += limit
+    pages = iterate_pages(fetcher, offset, rows_to_scan, prefetch_size)
+    try:
+        for offset, rows_scanned, response, documents, limit, last_page in pages:
+            if documents is not None:
+                min_date = write_activity_to_mongo(documents, account_id, fs_counters)
+                progress_bar.set_description(progress_desc_mask.format(step_name=step_name, limit=limit, offset=offset, rows=rows_scanned))
+                progress_bar.set_postfix(fs_counters)
+                progress_bar.update()
 
-        if response.status_code == 200:
-            documents = response.json()
-            min_date = write_activity_to_mongo(documents, account_id, fs_counters)
-            progress_bar.set_description(progress_desc_mask.format(step_name=step_name, limit=limit, offset=offset, rows=rows_scanned))
-            progress_bar.set_postfix(fs_counters)
-            progress_bar.update()
+                reached_high_water_mark = False
+                if checkpoint_endpoint and documents:
+                    page_dates = [document["updated_at"] for document in documents]
+                    run_high_water_mark = max(page_dates + ([run_high_water_mark] if run_high_water_mark else []))
+                    save_checkpoint_progress(account_id, checkpoint_endpoint, offset, run_high_water_mark)
+                    reached_high_water_mark = high_water_mark is not None and min(page_dates) <= high_water_mark
 
-            if (datetime.now() - min_date).days >= days_to_scan or len(documents) < limit_size:
+                if reached_high_water_mark or (datetime.now() - min_date).days >= days_to_scan or last_page:
+                    completed = True
+                    break
+            else:
+                print(f"Request failed with status code: {response.status_code}\t{response.text}")
                 break
         else:
-            print(f"Request failed with status code: {response.status_code}\t{response.text}")
-            break
+            completed = True
+    finally:
+        pages.close()
+        if checkpoint_endpoint and completed:
+            complete_checkpoint(account_id, checkpoint_endpoint, run_high_water_mark)
 
     progress_bar.close()
+    print(f"Scrape {step_name} | {fetcher.summary()}")
+    return fs_counters
 
 # Scrape activity for a specified number of days
-def scrape_activity(authorize_function, days_to_scan):
+def scrape_activity(authorize_function, days_to_scan, api_url=None, position=None, checkpoint_endpoint="activity"):
     user_id, headers, cookies = authorize_function()
     scrape_headers = {"sort": '{"created_at":"desc"}'}
-    request_by_limit(step_name=f"Statistics for {user_id}", account_id=user_id,
-                     url_string=activity_api_url, url_params=scrape_headers, url_headers=headers,
-                     offset_start=0, limit_size=40, rows_to_scan=999999, days_to_scan=days_to_scan)
+    with create_http_session() as session:
+        return request_by_limit(step_name=f"Statistics for {user_id}", account_id=user_id,
+                                url_params=scrape_headers, headers=headers,
+                                offset_start=0, limit_size=40, rows_to_scan=999999, days_to_scan=days_to_scan,
+                                session=session, api_url=api_url, position=position,
+                                checkpoint_endpoint=checkpoint_endpoint)
+
+# Scrape several accounts at the same time, each with its own pooled session and progress bar
+def scrape_accounts_concurrently(authorize_functions, days_to_scan, max_workers=scrape_concurrency, api_url=None):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(scrape_activity, authorize_function, days_to_scan, api_url, position)
+                   for position, authorize_function in enumerate(authorize_functions)]
+        return [future.result() for future in futures]
 
 # Main scraping process
-days_to_scan = 4
-for authorize_function in [authorize_creator_01_lina, authorize_creator_02_bad_liz, authorize_creator_03_young_mary, authorize_creator_04_princess, authorize_creator_05_anotherblonde]:
-    scrape_activity(authorize_function, days_to_scan)
+if __name__ == "__main__":
+    days_to_scan = 4
+    scrape_accounts_concurrently([authorize_creator_01_lina, authorize_creator_02_bad_liz, authorize_creator_03_young_mary,
+                                  authorize_creator_04_princess, authorize_creator_05_anotherblonde], days_to_scan)
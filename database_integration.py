@@ -1,5 +1,11 @@
 ﻿import os
-from pymongo import UpdateOne
+import threading
+import time
+import timeit
+from datetime import datetime
+from functools import lru_cache
+from queue import Empty, Full, Queue
+from pymongo import MongoClient, UpdateMany
 from tqdm import tqdm
 import cx_Oracle
 
@@ -14,46 +20,111 @@ oracle_service_name = "enter_oracle_service_name"
 oracle_user = "enter_oracle_user"
 oracle_password = "enter_oracle_password"
 
+mongo_uri = "enter_mongo_uri"
 mongo_db_name = "enter_mongo_db_name"
 mongo_collection_name = "enter_mongo_collection_name"
 
 dsn = cx_Oracle.makedsn(host=oracle_host, port=oracle_port, service_name=oracle_service_name)
 
-# Update MongoDB document status in bulk
-def update_mongo_status_bulk(document_ids, collection):
-    bulk_operations = [UpdateOne({"_id": doc["_id"]}, {"$set": {"_scrape_status": 1}}) for doc in document_ids]
-    collection.bulk_write(bulk_operations)
+# Pipeline settings: parallel Oracle sessions, Mongo cursor batch size and batches queued between stages
+oracle_sessions = 4
+mongo_cursor_batch_size = 2000
+pipeline_queue_size = 4
 
-# Insert batch of documents into Oracle
-def insert_batch_to_oracle(table_name, field_mapping, batch, cursor):
+# Load modes: row-wise MERGE from dual, or array insert into a staging table followed by one set-based MERGE
+load_mode_merge = "merge"
+load_mode_staging = "staging"
+
+# Acknowledge a committed batch with one bulk status update
+def acknowledge_mongo_batch(document_ids, collection):
+    collection.bulk_write([UpdateMany({"_id": {"$in": document_ids}}, {"$set": {"_scrape_status": 1}})], ordered=False)
+
+# Build a Mongo projection of the top-level fields used by field_mapping
+def build_projection(field_mapping):
+    projection = {"_id": 1}
+    for src in field_mapping:
+        projection[src.split('.')[0].split('[')[0]] = 1
+    return projection
+
+# Build the MERGE statement for a table and field mapping; source_query replaces the single-row SELECT from dual
+def build_merge_statement(table_name, field_mapping, source_query=None):
+    # Binds appear once each, in field_mapping order, so rows can be bound positionally as tuples
+    values = ', '.join([f'src.{dest}' for dest, _ in field_mapping.values()])
+    field_list = ', '.join([f':{dest} AS {dest}' for dest, (dest, _) in field_mapping.items()])
+    source_query = source_query or f"SELECT {field_list} FROM dual"
+
+    return f"""
+        MERGE INTO {table_name} dst
+        USING (
+            {source_query}
+        ) src
+        ON (dst.ID = src.ID)
+        WHEN MATCHED THEN
+            UPDATE SET {', '.join([f'dst.{dest} = src.{dest}' for dest, _ in field_mapping.values() if dest != "ID"])}
+        WHEN NOT MATCHED THEN
+            INSERT ({', '.join([dest for dest, _ in field_mapping.values()])})
+            VALUES ({values})
+    """
+
+# Name of the global temporary staging table for a table
+def staging_table_name(table_name):
+    return f"{table_name}_STG"
+
+# Hashable cache key for a field mapping
+def field_mapping_key(field_mapping):
+    return tuple((src, dest, data_type) for src, (dest, data_type) in field_mapping.items())
+
+# Build the SQL for both load modes once per table_name/field_mapping
+@lru_cache(maxsize=None)
+def build_oracle_statements(table_name, mapping_key):
+    field_mapping = {src: (dest, data_type) for src, dest, data_type in mapping_key}
+    columns = ', '.join([dest for _, dest, _ in mapping_key])
+    staging_table = staging_table_name(table_name)
+    return {
+        "merge": build_merge_statement(table_name, field_mapping),
+        "create_staging": f"CREATE GLOBAL TEMPORARY TABLE {staging_table} ON COMMIT DELETE ROWS "
+                          f"AS SELECT {columns} FROM {table_name} WHERE 1 = 0",
+        "load_staging": f"INSERT INTO {staging_table} ({columns}) "
+                        f"VALUES ({', '.join([f':{position}' for position in range(1, len(mapping_key) + 1)])})",
+        "merge_staging": build_merge_statement(table_name, field_mapping, f"SELECT {columns} FROM {staging_table}"),
+        "id_position": [dest for _, dest, _ in mapping_key].index("ID"),
+    }
+
+# Cached statements for a table and field mapping
+def oracle_statements(table_name, field_mapping):
+    return build_oracle_statements(table_name, field_mapping_key(field_mapping))
+
+# Create the staging table unless it already exists (ORA-00955)
+def ensure_staging_table(cursor, statements):
+    try:
+        cursor.execute(statements["create_staging"])
+    except cx_Oracle.DatabaseError as e:
+        error, = e.args
+        if error.code != 955:
+            raise
+
+# Merge row tuples into Oracle with the given load mode and commit.
+# The staging table is emptied by the commit; duplicate IDs are collapsed to the last row, as row-wise MERGE would leave them.
+def merge_rows_to_oracle(cursor, statements, rows, load_mode):
     try:
-        batch_data = []
-        for doc in batch:
-            data = {dest: process_field(doc, src, data_type) for src, (dest, data_type) in field_mapping.items()}
-            batch_data.append(data)
-
-        placeholders = ', '.join([f':{dest}' for dest, _ in field_mapping.values()])
-        field_list = ', '.join([f':{dest} AS {dest}' for dest, (dest, _) in field_mapping.items()])
-
-        merge_statement = f"""
-            MERGE INTO {table_name} dst
-            USING (
-                SELECT {field_list}
-                FROM dual
-            ) src
-            ON (dst.ID = src.ID)
-            WHEN MATCHED THEN
-                UPDATE SET {', '.join([f'dst.{dest} = src.{dest}' for dest, _ in field_mapping.values() if dest != "ID"])}
-            WHEN NOT MATCHED THEN
-                INSERT ({', '.join([dest for dest, _ in field_mapping.values()])})
-                VALUES ({placeholders})
-        """
-
-        cursor.executemany(merge_statement, batch_data)
+        if load_mode == load_mode_staging:
+            id_position = statements["id_position"]
+            cursor.executemany(statements["load_staging"], list({row[id_position]: row for row in rows}.values()))
+            cursor.execute(statements["merge_staging"])
+        else:
+            cursor.executemany(statements["merge"], rows)
         cursor.connection.commit()
-    except Exception as e:
+    except Exception:
         cursor.connection.rollback()
-        raise e
+        raise
+
+# Convert a batch of documents into bind rows with process_field
+def convert_batch(batch, field_mapping):
+    return [{dest: process_field(doc, src, data_type) for src, (dest, data_type) in field_mapping.items()} for doc in batch]
+
+# Insert batch of documents into Oracle
+def insert_batch_to_oracle(table_name, field_mapping, batch, cursor, load_mode=load_mode_merge):
+    merge_rows_to_oracle(cursor, oracle_statements(table_name, field_mapping), compile_field_mapping(field_mapping)(batch), load_mode)
 
 # Process field data according to the mapping
 def process_field(document, field_path, data_type):
@@ -73,30 +144,239 @@ def process_field(document, field_path, data_type):
         return str(value)[:4000]
     return value
 
-# Main function to integrate MongoDB and Oracle
-def insert_collections_to_oracle(collection_name, table_name, field_mapping, batch_size):
+# Compile a dotted, indexed field path (e.g. a.b[0].c) into an accessor with the same semantics as process_field
+def compile_field_path(field_path):
+    steps = []
+    for key in field_path.split('.'):
+        if '[' in key:
+            key, index = key.split('[')
+            steps.append((key, int(index.rstrip(']'))))
+        else:
+            steps.append((key, None))
+
+    if len(steps) == 1 and steps[0][1] is None:
+        key = steps[0][0]
+        return lambda document: document.get(key)
+
+    def accessor(document):
+        value = document
+        for key, index in steps:
+            if index is None:
+                value = value.get(key)
+            else:
+                value = value.get(key, [])
+                value = value[index] if isinstance(value, list) else None
+            if value is None:
+                return None
+        return value
+    return accessor
+
+# Coerce numeric strings and booleans for NUMBER columns
+def to_number(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value
+    return value
+
+# Coerce ISO 8601 strings for DATE and TIMESTAMP columns
+def to_date(value):
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return value
+    return value
+
+# Pick the converter for an Oracle data type
+def field_converter(data_type):
+    if data_type.startswith("VARCHAR2"):
+        return lambda value: str(value)[:4000]
+    if data_type.startswith("NUMBER"):
+        return to_number
+    if data_type.startswith(("DATE", "TIMESTAMP")):
+        return to_date
+    return None
+
+# Compile one field into a single extractor closure: accessor plus converter
+def compile_field_extractor(field_path, data_type):
+    accessor, converter = compile_field_path(field_path), field_converter(data_type)
+    if converter is None:
+        return accessor
+
+    def extractor(document):
+        value = accessor(document)
+        return None if value is None else converter(value)
+    return extractor
+
+# Compile field_mapping once into a function turning a batch of documents into row tuples in field_mapping order
+def compile_field_mapping(field_mapping):
+    extractors = [compile_field_extractor(src, data_type) for src, (_, data_type) in field_mapping.items()]
+
+    def convert_rows(batch):
+        return [tuple([extract(doc) for extract in extractors]) for doc in batch]
+    return convert_rows
+
+# Microbenchmark: process_field per document against the compiled extractors
+def benchmark_field_conversion(field_mapping, documents, repeat=5):
+    convert_rows = compile_field_mapping(field_mapping)
+    process_field_time = min(timeit.repeat(lambda: convert_batch(documents, field_mapping), number=1, repeat=repeat))
+    compiled_time = min(timeit.repeat(lambda: convert_rows(documents), number=1, repeat=repeat))
+    print(f"process_field: {len(documents) / process_field_time:,.0f} docs/sec | "
+          f"compiled: {len(documents) / compiled_time:,.0f} docs/sec | speedup: {process_field_time / compiled_time:.1f}x")
+    return process_field_time, compiled_time
+
+# Per-stage document counts and busy seconds, shared by the pipeline threads
+class StageStats:
+    def __init__(self, stages):
+        self.lock = threading.Lock()
+        self.stats = {stage: [0, 0.0] for stage in stages}
+
+    def record(self, stage, documents, seconds):
+        with self.lock:
+            stage_stat = self.stats.setdefault(stage, [0, 0.0])
+            stage_stat[0] += documents
+            stage_stat[1] += seconds
+
+    # Docs/sec of busy time per stage; the lowest rate is the bottleneck
+    def rates(self):
+        with self.lock:
+            return {stage: round(documents / seconds) if seconds else 0 for stage, (documents, seconds) in self.stats.items()}
+
+# Put an item into a pipeline queue, giving up once the pipeline has stopped
+def put_unless_stopped(stage_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
+
+# Get an item from a pipeline queue, returning None once the pipeline has stopped
+def get_unless_stopped(stage_queue, stop_event):
+    while not stop_event.is_set():
+        try:
+            return stage_queue.get(timeout=0.1)
+        except Empty:
+            continue
+    return None
+
+# Main function to integrate MongoDB and Oracle.
+# Mongo batches are read with a projection built from field_mapping, converted to bind rows in a worker thread and
+# merged by several Oracle sessions from a session pool in parallel. Each batch is acknowledged in Mongo after its commit.
+# load_mode "staging" loads each batch into a staging table and merges it set-based, falling back to row-wise MERGE on failure.
+def insert_collections_to_oracle(collection_name, table_name, field_mapping, batch_size, sessions=oracle_sessions,
+                                 load_mode=load_mode_merge):
     os.environ["NLS_LANG"] = "AMERICAN_AMERICA.AL32UTF8"
 
-    with cx_Oracle.connect(user=oracle_user, password=oracle_password, dsn=dsn) as oracle_connection, \
-         oracle_connection.cursor() as oracle_cursor:
+    mongo_client = MongoClient(mongo_uri)
+    mongo_collection = mongo_client[mongo_db_name][collection_name]
+    statements = oracle_statements(table_name, field_mapping)
+    convert_rows = compile_field_mapping(field_mapping)
+
+    query = {"_scrape_status": 0}
+    total_documents = mongo_collection.count_documents(query)
+
+    stage_stats = StageStats(["read", "convert", f"oracle_{load_mode}", "ack"])
+    convert_queue, write_queue = Queue(maxsize=pipeline_queue_size), Queue(maxsize=pipeline_queue_size)
+    stop_event, errors = threading.Event(), []
+
+    def convert_worker():
+        try:
+            while (batch := get_unless_stopped(convert_queue, stop_event)) is not None and batch:
+                start_time = time.perf_counter()
+                rows = convert_rows(batch)
+                stage_stats.record("convert", len(batch), time.perf_counter() - start_time)
+                if not put_unless_stopped(write_queue, ([doc["_id"] for doc in batch], rows), stop_event):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            for _ in range(sessions):
+                put_unless_stopped(write_queue, (), stop_event)
 
-        mongo_client = MongoClient(mongo_db_name)
-        mongo_collection = mongo_client[mongo_collection_name]
+    def oracle_worker(session_pool, pbar, worker_load_mode):
+        try:
+            with session_pool.acquire() as connection, connection.cursor() as cursor:
+                while (item := get_unless_stopped(write_queue, stop_event)) is not None and item:
+                    document_ids, rows = item
+                    start_time = time.perf_counter()
+                    try:
+                        merge_rows_to_oracle(cursor, statements, rows, worker_load_mode)
+                    except cx_Oracle.DatabaseError as e:
+                        if worker_load_mode != load_mode_staging:
+                            raise
+                        print(f"Staging load into {table_name} failed, falling back to row-wise MERGE: {e}")
+                        worker_load_mode, start_time = load_mode_merge, time.perf_counter()
+                        merge_rows_to_oracle(cursor, statements, rows, worker_load_mode)
+                    stage_stats.record(f"oracle_{worker_load_mode}", len(rows), time.perf_counter() - start_time)
 
-        query = {"_scrape_status": 0}
-        total_documents = mongo_collection.count_documents(query)
+                    start_time = time.perf_counter()
+                    acknowledge_mongo_batch(document_ids, mongo_collection)
+                    stage_stats.record("ack", len(document_ids), time.perf_counter() - start_time)
+                    pbar.update(len(rows))
+                    pbar.set_postfix(stage_stats.rates())
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+
+    session_pool = cx_Oracle.SessionPool(user=oracle_user, password=oracle_password, dsn=dsn,
+                                         min=1, max=sessions, increment=1, threaded=True)
+    try:
+        if load_mode == load_mode_staging:
+            try:
+                with session_pool.acquire() as connection, connection.cursor() as cursor:
+                    ensure_staging_table(cursor, statements)
+            except cx_Oracle.DatabaseError as e:
+                print(f"Cannot create {staging_table_name(table_name)}, falling back to row-wise MERGE: {e}")
+                load_mode = load_mode_merge
 
         with tqdm(total=total_documents, desc=f"Inserting {collection_name} into {table_name}") as pbar:
-            batch = []
-            for doc in mongo_collection.find(query):
-                batch.append(doc)
-                if len(batch) >= batch_size:
-                    insert_batch_to_oracle(table_name, field_mapping, batch, oracle_cursor)
-                    update_mongo_status_bulk(batch, mongo_collection)
-                    batch.clear()
-                    pbar.update(batch_size)
-
-            if batch:
-                insert_batch_to_oracle(table_name, field_mapping, batch, oracle_cursor)
-                update_mongo_status_bulk(batch, mongo_collection)
-                pbar.update(len(batch))
+            workers = [threading.Thread(target=convert_worker)] + \
+                      [threading.Thread(target=oracle_worker, args=(session_pool, pbar, load_mode)) for _ in range(sessions)]
+            for worker in workers:
+                worker.start()
+
+            try:
+                cursor = mongo_collection.find(query, build_projection(field_mapping)).batch_size(mongo_cursor_batch_size)
+                batch, start_time = [], time.perf_counter()
+                for doc in cursor:
+                    batch.append(doc)
+                    if len(batch) >= batch_size:
+                        stage_stats.record("read", len(batch), time.perf_counter() - start_time)
+                        if not put_unless_stopped(convert_queue, batch, stop_event):
+                            break
+                        batch, start_time = [], time.perf_counter()
+
+                if batch and not stop_event.is_set():
+                    stage_stats.record("read", len(batch), time.perf_counter() - start_time)
+                    put_unless_stopped(convert_queue, batch, stop_event)
+            finally:
+                put_unless_stopped(convert_queue, [], stop_event)
+                for worker in workers:
+                    worker.join()
+    finally:
+        session_pool.close()
+        mongo_client.close()
+
+    if errors:
+        raise errors[0]
+    print(f"Docs/sec per stage for {collection_name}: {stage_stats.rates()}")
+
+# Run the field conversion microbenchmark on synthetic documents
+if __name__ == "__main__":
+    sample_mapping = {"_id": ("ID", "NUMBER"), "user.name": ("USER_NAME", "VARCHAR2(200)"),
+                      "user.stats.followers": ("FOLLOWERS", "NUMBER"), "media[0].url": ("MEDIA_URL", "VARCHAR2(4000)"),
+                      "media[1].size": ("MEDIA_SIZE", "NUMBER"), "created_at": ("CREATED_AT", "DATE"), "title": ("TITLE", "VARCHAR2(4000)")}
+    sample_documents = [{"_id": i, "user": {"name": f"user_{i}", "stats": {"followers": i * 3}},
+                         "media": [{"url": f"https://example.com/{i}.jpg"}, {"size": i % 997}],
+                         "created_at": datetime(2024, 1, 1), "title": "t" * (i % 50)} for i in range(200000)]
+    benchmark_field_conversion(sample_mapping, sample_documents)
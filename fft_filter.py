@@ -4,9 +4,84 @@
 # It filters out frequencies outside a specified range.
 # The script requires numpy and matplotlib libraries.
 # Usage: Call fft_filter with signal, min_freq, max_freq, and sample_rate.
+# fft_filter_real filters real signals, one or many along an axis; stream_fft_filter filters chunked input of any length.
+# get_filter_plan caches masks and buffers for repeated filtering of signals with the same length and band.
 
+import itertools
+import time
+from functools import lru_cache
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.fft import next_fast_len
+
+# Number of filter plans kept for repeated (length, sample_rate, band) combinations
+FILTER_PLAN_CACHE_SIZE = 32
+
+def band_mask(freq, min_freq, max_freq, transition=0.0):
+    """
+    Spectral weights for a band: 1 for min_freq <= |f| <= max_freq, 0 outside, with raised-cosine edges of
+    width transition (Hz) outside the band when transition > 0.
+    """
+    freq = np.abs(freq)
+    mask = ((freq >= min_freq) & (freq <= max_freq)).astype(np.float64)
+    if transition > 0:
+        lower = (freq < min_freq) & (freq > min_freq - transition)
+        mask[lower] = 0.5 * (1 + np.cos(np.pi * (min_freq - freq[lower]) / transition))
+        upper = (freq > max_freq) & (freq < max_freq + transition)
+        mask[upper] = 0.5 * (1 + np.cos(np.pi * (freq[upper] - max_freq) / transition))
+    return mask
+
+@lru_cache(maxsize=FILTER_PLAN_CACHE_SIZE)
+def cached_band_mask(length, sample_rate, min_freq, max_freq, transition=0.0, real=True):
+    """
+    Cached read-only band_mask for the rfft (real=True) or full fft spectrum of a signal of the given length.
+    """
+    freq = np.fft.rfftfreq(length, d=1/sample_rate) if real else np.fft.fftfreq(length, d=1/sample_rate)
+    mask = band_mask(freq, min_freq, max_freq, transition)
+    mask.flags.writeable = False
+    return mask
+
+class FilterPlan:
+    """
+    Precomputed real-FFT band filter for signals of one length: spectral mask, FFT length and work buffers.
+    With pad=True the FFT length is the next FFT-friendly length and the signal is extended by reflection;
+    with pad=False and transition=0 results equal fft_filter_real.
+    A plan reuses its buffers, so one plan must not be applied from several threads at once.
+    """
+
+    def __init__(self, length, sample_rate, min_freq, max_freq, transition=0.0, pad=False):
+        self.length = length
+        self.fft_length = next_fast_len(length, real=True) if pad else length
+        self.mask = cached_band_mask(self.fft_length, sample_rate, min_freq, max_freq, transition)
+        self.signal_buffer = np.zeros(self.fft_length)
+        self.spectrum_buffer = np.zeros(len(self.mask), dtype=np.complex128)
+        self.output_buffer = np.zeros(self.fft_length)
+
+    def apply(self, signal, out=None):
+        """
+        Filter one real signal of the plan's length into out (a new array when not given).
+        """
+        extension = self.fft_length - self.length
+        self.signal_buffer[:self.length] = signal
+        if extension:
+            # Reflect the end of the signal so the padding adds no jump at the boundary
+            reflected = min(extension, self.length - 1)
+            self.signal_buffer[self.length:self.length + reflected] = self.signal_buffer[self.length - 2::-1][:reflected]
+            self.signal_buffer[self.length + reflected:] = 0
+        np.fft.rfft(self.signal_buffer, out=self.spectrum_buffer)
+        np.multiply(self.spectrum_buffer, self.mask, out=self.spectrum_buffer)
+        np.fft.irfft(self.spectrum_buffer, n=self.fft_length, out=self.output_buffer)
+        if out is None:
+            return self.output_buffer[:self.length].copy()
+        out[:] = self.output_buffer[:self.length]
+        return out
+
+@lru_cache(maxsize=FILTER_PLAN_CACHE_SIZE)
+def get_filter_plan(length, sample_rate, min_freq, max_freq, transition=0.0, pad=False):
+    """
+    Cached FilterPlan for (length, sample_rate, band); see FilterPlan.
+    """
+    return FilterPlan(length, sample_rate, min_freq, max_freq, transition, pad)
 
 def fft_filter(signal, min_freq, max_freq, sample_rate):
     """
@@ -20,31 +95,161 @@ def fft_filter(signal, min_freq, max_freq, sample_rate):
     """
     # Perform FFT
     fft_result = np.fft.fft(signal)
-    freq = np.fft.fftfreq(len(signal), d=1/sample_rate)
 
-    # Filter frequencies
-    fft_result[np.abs(freq) < min_freq] = 0
-    fft_result[np.abs(freq) > max_freq] = 0
+    # Filter frequencies with the cached mask for this length and band
+    fft_result *= cached_band_mask(len(signal), sample_rate, min_freq, max_freq, real=False)
 
     # Perform inverse FFT
     filtered_signal = np.fft.ifft(fft_result)
     return filtered_signal
 
-# Example usage
-sample_rate = 1000  # Hertz
-t = np.linspace(0, 1, sample_rate, endpoint=False)
-signal = np.sin(2*np.pi*50*t) + np.sin(2*np.pi*120*t)  # Mixed signal
-
-# Filter out the 120 Hz frequency
-filtered_signal = fft_filter(signal, 40, 100, sample_rate)
-
-# Visualization
-plt.figure(figsize=(12, 6))
-plt.subplot(2, 1, 1)
-plt.plot(t, signal)
-plt.title("Original Signal")
-plt.subplot(2, 1, 2)
-plt.plot(t, filtered_signal.real)
-plt.title("Filtered Signal")
-plt.tight_layout()
-plt.show()
+def fft_filter_real(signal, min_freq, max_freq, sample_rate, axis=-1):
+    """
+    Apply the same filter as fft_filter to real signals with a real FFT, returning float output.
+    A 2-D array of signals is filtered along axis in one call.
+
+    :param signal: Real input signal or array of signals.
+    :param min_freq: Minimum frequency to retain.
+    :param max_freq: Maximum frequency to retain.
+    :param sample_rate: Sampling rate of the signal.
+    :param axis: Axis along which the signals run.
+    :return: Filtered signal with the shape of the input.
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    length = signal.shape[axis]
+    spectrum = np.fft.rfft(signal, axis=axis)
+    mask = cached_band_mask(length, sample_rate, min_freq, max_freq)
+
+    # Zero the frequencies outside the band, broadcast along the signal axis
+    mask_shape = [1] * signal.ndim
+    mask_shape[axis] = len(mask)
+    spectrum *= mask.reshape(mask_shape)
+    return np.fft.irfft(spectrum, n=length, axis=axis)
+
+def design_band_fir(min_freq, max_freq, sample_rate, taps):
+    """
+    Windowed-sinc FIR approximating the fft_filter band, for streaming use.
+
+    :param taps: Odd filter length; the transition band is about 5.5 * sample_rate / taps wide (Blackman window).
+    :return: Symmetric impulse response with a delay of (taps - 1) / 2 samples.
+    """
+    n = np.arange(taps) - (taps - 1) / 2
+    band = 2 * max_freq / sample_rate * np.sinc(2 * max_freq / sample_rate * n)
+    if min_freq > 0:
+        band -= 2 * min_freq / sample_rate * np.sinc(2 * min_freq / sample_rate * n)
+    return band * np.blackman(taps)
+
+def stream_fft_filter(chunks, min_freq, max_freq, sample_rate, taps=2049, block_size=16384):
+    """
+    Overlap-save FIR filtering of chunked input of any length with constant memory.
+    Chunks may have any size, e.g. slices of a memmapped file or items of a generator. Output is aligned with the input
+    (the FIR delay is removed) and yielded in blocks; the total output length equals the total input length.
+    Away from the ends it matches fft_filter on the whole signal up to the FIR approximation.
+
+    :param chunks: Iterable of 1-D real arrays.
+    :param taps: Odd FIR length, see design_band_fir.
+    :param block_size: Minimum new samples per FFT block.
+    :return: Generator of filtered float arrays.
+    """
+    fft_size = next_fast_len(block_size + taps - 1)
+    step = fft_size - taps + 1
+    response = np.fft.rfft(design_band_fir(min_freq, max_freq, sample_rate, taps), fft_size)
+    delay = (taps - 1) // 2
+
+    # window holds taps - 1 samples of history followed by up to step new samples
+    window, pending, to_skip = np.zeros(fft_size), 0, delay
+
+    def filter_window(new_samples):
+        nonlocal to_skip
+        output = np.fft.irfft(np.fft.rfft(window) * response, fft_size)[taps - 1:taps - 1 + new_samples]
+        window[:taps - 1] = window[new_samples:new_samples + taps - 1]
+        skipped = min(to_skip, len(output))
+        to_skip -= skipped
+        return output[skipped:]
+
+    # The FIR delay is dropped from the start of the output and flushed with as many trailing zeros
+    for chunk in itertools.chain(chunks, [np.zeros(delay)]):
+        chunk = np.asarray(chunk, dtype=np.float64).ravel()
+        while len(chunk):
+            taken = min(step - pending, len(chunk))
+            window[taps - 1 + pending:taps - 1 + pending + taken] = chunk[:taken]
+            pending, chunk = pending + taken, chunk[taken:]
+            if pending == step:
+                output, pending = filter_window(step), 0
+                if len(output):
+                    yield output
+    if pending:
+        window[taps - 1 + pending:] = 0
+        output = filter_window(pending)
+        if len(output):
+            yield output
+
+def check_fft_filter_accuracy(sample_rate=1000, length=20000, seed=0):
+    """
+    Compare the real, batched and streaming paths against fft_filter and print the largest differences.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(length) / sample_rate
+    signals = np.sin(2*np.pi*50*t) + np.sin(2*np.pi*120*t) + 0.1 * rng.normal(size=(8, length))
+    reference = np.array([fft_filter(signal, 40, 100, sample_rate) for signal in signals])
+
+    real_error = np.abs(fft_filter_real(signals[0], 40, 100, sample_rate) - reference[0].real).max()
+    batch_error = np.abs(fft_filter_real(signals, 40, 100, sample_rate) - reference.real).max()
+    batch_axis0_error = np.abs(fft_filter_real(signals.T, 40, 100, sample_rate, axis=0) - reference.real.T).max()
+    pure_tone = np.sin(2*np.pi*50*t) + np.sin(2*np.pi*120*t)
+    chunks = np.array_split(pure_tone, 37)
+    streamed = np.concatenate(list(stream_fft_filter(chunks, 40, 100, sample_rate, block_size=4096)))
+    edge = 4096
+    stream_error = np.abs(streamed[edge:-edge] - fft_filter(pure_tone, 40, 100, sample_rate).real[edge:-edge]).max()
+
+    plan_error = np.abs(get_filter_plan(length, sample_rate, 40, 100).apply(signals[0]) - reference[0].real).max()
+    padded_plan = get_filter_plan(length - 1, sample_rate, 40, 100, transition=2.0, pad=True)
+    padded_error = np.abs(padded_plan.apply(pure_tone[:-1]) - fft_filter(pure_tone, 40, 100, sample_rate).real[:-1])[edge:-edge].max()
+
+    print(f"rfft vs fft: {real_error:.2e}, batched: {batch_error:.2e}, batched axis 0: {batch_axis0_error:.2e}, "
+          f"streaming (interior, {len(streamed)} of {length} samples): {stream_error:.2e}, plan: {plan_error:.2e}, "
+          f"padded plan with raised-cosine edges (interior, FFT length {padded_plan.fft_length}): {padded_error:.2e}")
+    assert real_error < 1e-10 and batch_error < 1e-10 and batch_axis0_error < 1e-10 and plan_error < 1e-10
+    assert len(streamed) == length and stream_error < 1e-3 and padded_error < 1e-2
+
+def benchmark_fft_filter(sample_rate=1000, length=1 << 16, signal_count=256, seed=0):
+    """
+    Print throughput in million samples per second of fft_filter, fft_filter_real per signal and batched, and streaming.
+    """
+    signals = np.random.default_rng(seed).normal(size=(signal_count, length))
+    total = signals.size / 1e6
+
+    def timed(label, run):
+        start_time = time.perf_counter()
+        run()
+        print(f"{label}: {total / (time.perf_counter() - start_time):.1f} Msamples/s")
+
+    timed("fft_filter", lambda: [fft_filter(signal, 40, 100, sample_rate) for signal in signals])
+    timed("fft_filter_real", lambda: [fft_filter_real(signal, 40, 100, sample_rate) for signal in signals])
+    timed("fft_filter_real batched", lambda: fft_filter_real(signals, 40, 100, sample_rate))
+    plan, output = get_filter_plan(length, sample_rate, 40, 100), np.empty(length)
+    timed("cached filter plan", lambda: [plan.apply(signal, out=output) for signal in signals])
+    timed("stream_fft_filter", lambda: [block for block in stream_fft_filter(iter(signals), 40, 100, sample_rate)])
+
+# Example usage, accuracy checks and throughput benchmark
+if __name__ == "__main__":
+    sample_rate = 1000  # Hertz
+    t = np.linspace(0, 1, sample_rate, endpoint=False)
+    signal = np.sin(2*np.pi*50*t) + np.sin(2*np.pi*120*t)  # Mixed signal
+
+    # Filter out the 120 Hz frequency
+    filtered_signal = fft_filter(signal, 40, 100, sample_rate)
+
+    check_fft_filter_accuracy()
+    benchmark_fft_filter()
+
+    # Visualization
+    plt.figure(figsize=(12, 6))
+    plt.subplot(2, 1, 1)
+    plt.plot(t, signal)
+    plt.title("Original Signal")
+    plt.subplot(2, 1, 2)
+    plt.plot(t, filtered_signal.real)
+    plt.title("Filtered Signal")
+    plt.tight_layout()
+    plt.show()
@@ -1,7 +1,10 @@
 ﻿from datetime import datetime
 import psycopg2
-from tqdm import tqdm
-from io import StringIO
+from psycopg2.extras import execute_values
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+import sys
+import time
 
 # Author: Ruslana Kruk
 # This script aggregates index data from multiple PostgreSQL nodes and inserts the aggregated data into a table.
@@ -16,6 +19,37 @@ sql_query = """
     idx_scan, idx_tup_read, idx_tup_fetch FROM vw_index_by_node v
 """
 
+# Column names for the table
+column_names = ["snapshot_datetime", "srv_ip", "relid", "indexrelid", "schemaname", "relname", "indexrelname",
+                "idx_scan", "idx_tup_read", "idx_tup_fetch"]
+
+# Rows fetched per round trip from each node and chunks buffered between the nodes and the COPY stream
+fetch_size = 500
+stream_queue_size = 64
+
+# Sampler settings: polling interval in seconds, delta table and rolling aggregate resolutions
+sample_interval = 60
+delta_table_name = "index_data_delta"
+rollup_resolutions = ["minute", "hour", "day"]
+delta_column_names = ["snapshot_datetime", "interval_seconds", "srv_ip", "relid", "indexrelid", "schemaname", "relname",
+                      "indexrelname", "idx_scan", "idx_tup_read", "idx_tup_fetch"]
+
+sampler_tables_sql = f"""
+    CREATE TABLE IF NOT EXISTS {delta_table_name} (
+        snapshot_datetime timestamptz, interval_seconds double precision, srv_ip text, relid oid, indexrelid oid,
+        schemaname name, relname name, indexrelname name, idx_scan bigint, idx_tup_read bigint, idx_tup_fetch bigint
+    );
+""" + "".join(f"""
+    CREATE TABLE IF NOT EXISTS index_usage_{resolution} (
+        bucket_start timestamptz, srv_ip text, indexrelid oid, schemaname name, relname name, indexrelname name,
+        idx_scan bigint, idx_tup_read bigint, idx_tup_fetch bigint, samples integer,
+        PRIMARY KEY (bucket_start, srv_ip, indexrelid)
+    );
+""" for resolution in rollup_resolutions)
+
+# COPY text format escapes
+copy_escapes = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
 # Function to connect and execute SQL query
 def connect_and_execute_query(connection_info, query):
     with psycopg2.connect(**connection_info) as conn:
@@ -23,37 +57,164 @@ def connect_and_execute_query(connection_info, query):
             cursor.execute(query)
             return cursor.fetchall()
 
-# Function to insert data using copy_from
-def insert_data_copy(node_address, data, column_names):
-    node_db_credentials = db_credentials.copy()
-    node_db_credentials["host"] = node_address
+# Format a row as a COPY text line with NULL and escape handling
+def format_copy_row(row):
+    return '\t'.join(['\\N' if value is None else str(value).translate(copy_escapes) for value in row]) + '\n'
+
+# File-like object feeding COPY FROM STDIN with lines produced by the node workers
+class CopyStream:
+    def __init__(self, producers):
+        self.chunks = Queue(maxsize=stream_queue_size)
+        self.producers = producers
+        self.buffer = ''
+
+    def put(self, chunk):
+        self.chunks.put(chunk)
+
+    def read(self, size=-1):
+        while self.producers and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk is None:
+                self.producers -= 1
+            else:
+                self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
 
-    with psycopg2.connect(**node_db_credentials) as conn:
+    # Consume the remaining chunks so node workers blocked on a full queue can finish
+    def drain(self):
+        while self.producers:
+            if self.chunks.get() is None:
+                self.producers -= 1
+
+# Stream one node's rows into the COPY stream and return the node's timing
+def stream_node_rows(node_address, query, stream):
+    start_time, row_count = time.perf_counter(), 0
+    try:
+        with psycopg2.connect(**db_credentials, host=node_address) as conn:
+            with conn.cursor(name=f"index_data_{node_address}") as cursor:
+                cursor.itersize = fetch_size
+                cursor.execute(query)
+                while rows := cursor.fetchmany(fetch_size):
+                    row_count += len(rows)
+                    stream.put(''.join([format_copy_row(row) for row in rows]))
+    except Exception as e:
+        stream.put(e)
+        raise
+    finally:
+        stream.put(None)
+    return node_address, row_count, time.perf_counter() - start_time
+
+# Query all nodes concurrently and write their rows to index_data through a single connection and COPY
+def collect_index_data(query=sql_query, target_node=node_addresses[0], table_name="index_data"):
+    stream = CopyStream(len(node_addresses))
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(node_addresses)) as executor:
+        futures = [executor.submit(stream_node_rows, node_address, query, stream) for node_address in node_addresses]
+        try:
+            with psycopg2.connect(**db_credentials, host=target_node) as conn:
+                with conn.cursor() as cursor:
+                    cursor.copy_expert(f"COPY {table_name} ({', '.join(column_names)}) FROM STDIN", stream)
+        except Exception:
+            stream.drain()
+            raise
+        node_timings = [future.result() for future in futures]
+
+    for node_address, row_count, seconds in node_timings:
+        print(f"{node_address}: {row_count} rows in {seconds:.2f}s")
+    print(f"Collection window: {time.perf_counter() - start_time:.2f}s")
+    return node_timings
+
+# Fetch one node's counters, or None when the node cannot be queried
+def fetch_node_snapshot(node_address, query):
+    try:
+        return connect_and_execute_query(db_credentials | {"host": node_address}, query)
+    except Exception as e:
+        print(f"{datetime.now()} - Failed to fetch index counters from {node_address}: {e}")
+        return None
+
+# Fetch the current counters from all nodes concurrently, keyed by node; nodes that failed are left out
+def fetch_index_snapshot(query=sql_query):
+    with ThreadPoolExecutor(max_workers=len(node_addresses)) as executor:
+        node_rows = executor.map(lambda node_address: fetch_node_snapshot(node_address, query), node_addresses)
+        return {node_address: rows for node_address, rows in zip(node_addresses, node_rows) if rows is not None}
+
+# Compute per-interval deltas against the previous snapshot, keyed by (srv_ip, indexrelid).
+# A counter lower than before means stats were reset or the node restarted, so the current value is the delta.
+# Indexes without activity in the interval are skipped.
+def compute_index_deltas(previous_snapshot, snapshot_rows):
+    current_snapshot, deltas = {}, []
+    for row in snapshot_rows:
+        key, counters = (row[1], row[3]), row[7:10]
+        current_snapshot[key] = (row[0], counters)
+        if key not in previous_snapshot:
+            continue
+        previous_datetime, previous_counters = previous_snapshot[key]
+        if any(current < previous for current, previous in zip(counters, previous_counters)):
+            delta = tuple(counters)
+        else:
+            delta = tuple(current - previous for current, previous in zip(counters, previous_counters))
+        if any(delta):
+            deltas.append((row[0], (row[0] - previous_datetime).total_seconds(), *row[1:7], *delta))
+    return current_snapshot, deltas
+
+# Write deltas with COPY and add them to the minute/hour/day rollups, in one transaction
+def write_index_deltas(deltas, target_node=node_addresses[0]):
+    with psycopg2.connect(**db_credentials, host=target_node) as conn:
         with conn.cursor() as cursor:
-            data_io = StringIO()
-            for row in data:
-                data_io.write('\t'.join(map(str, row)) + '\n')
-            data_io.seek(0)
-            cursor.copy_from(data_io, 'index_data', columns=column_names, sep='\t')
-            conn.commit()
+            stream = CopyStream(1)
+            stream.put(''.join([format_copy_row(delta) for delta in deltas]))
+            stream.put(None)
+            cursor.copy_expert(f"COPY {delta_table_name} ({', '.join(delta_column_names)}) FROM STDIN", stream)
 
-print(f"Start index data collection at {datetime.now()}")
+            rollup_rows = [(snapshot_datetime, srv_ip, indexrelid, schemaname, relname, indexrelname, idx_scan, idx_tup_read, idx_tup_fetch)
+                           for snapshot_datetime, _, srv_ip, _, indexrelid, schemaname, relname, indexrelname, idx_scan, idx_tup_read, idx_tup_fetch in deltas]
+            for resolution in rollup_resolutions:
+                execute_values(cursor, f"""
+                    INSERT INTO index_usage_{resolution} AS t (bucket_start, srv_ip, indexrelid, schemaname, relname, indexrelname,
+                                                              idx_scan, idx_tup_read, idx_tup_fetch, samples)
+                    VALUES %s
+                    ON CONFLICT (bucket_start, srv_ip, indexrelid) DO UPDATE SET
+                        idx_scan = t.idx_scan + EXCLUDED.idx_scan, idx_tup_read = t.idx_tup_read + EXCLUDED.idx_tup_read,
+                        idx_tup_fetch = t.idx_tup_fetch + EXCLUDED.idx_tup_fetch, samples = t.samples + 1
+                """, rollup_rows, template=f"(date_trunc('{resolution}', %s), %s, %s, %s, %s, %s, %s, %s, %s, 1)")
 
-# Accumulate data from all nodes
-accumulated_data = []
-for node_address in tqdm(node_addresses, desc="Retrieving data"):
-    node_data = connect_and_execute_query(db_credentials | {"host": node_address}, sql_query)
-    accumulated_data.extend(node_data)
+# Long-running sampler: poll every interval on a fixed schedule and write only the deltas
+def run_index_sampler(interval=sample_interval, target_node=node_addresses[0]):
+    with psycopg2.connect(**db_credentials, host=target_node) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sampler_tables_sql)
 
-# Column names for the table
-column_names = ["snapshot_datetime", "srv_ip", "relid", "indexrelid", "schemaname", "relname", "indexrelname",
-                "idx_scan", "idx_tup_read", "idx_tup_fetch"]
+    # Previous counters per node. A node that fails keeps its previous counters, so its next delta spans the gap;
+    # the snapshots only advance after the deltas are written, so a failed write is folded into the next interval.
+    node_snapshots, next_run = {}, time.monotonic()
+    while True:
+        start_time = time.perf_counter()
+        try:
+            current_snapshots, deltas = {}, []
+            for node_address, rows in fetch_index_snapshot().items():
+                current_snapshots[node_address], node_deltas = compute_index_deltas(node_snapshots.get(node_address, {}), rows)
+                deltas += node_deltas
+            if deltas:
+                write_index_deltas(deltas, target_node)
+            node_snapshots.update(current_snapshots)
+            print(f"{datetime.now()} - {len(deltas)} index deltas written in {time.perf_counter() - start_time:.2f}s")
+        except Exception as e:
+            print(f"{datetime.now()} - Index sample failed, retrying at the next interval: {e}")
 
-# Batch size for data insertion
-batch_size = 500
-for i in tqdm(range(0, len(accumulated_data), batch_size), desc="Inserting data"):
-    batch = accumulated_data[i:i + batch_size]
-    insert_data_copy(node_addresses[0], batch, column_names)
+        next_run += interval
+        time.sleep(max(0.0, next_run - time.monotonic()))
 
-print(f"Data accumulated and written to public.Index_DATA on {node_addresses[0]}")
-print(f"End index data collection at {datetime.now()}")
+# Run once as before, or "python index_data_aggregator.py sample" for the continuous sampler
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "sample":
+        run_index_sampler()
+    else:
+        print(f"Start index data collection at {datetime.now()}")
+        collect_index_data()
+        print(f"Data accumulated and written to public.Index_DATA on {node_addresses[0]}")
+        print(f"End index data collection at {datetime.now()}")
@@ -0,0 +1,179 @@
+﻿import time
+from collections import deque
+import numpy
+from scipy.signal import argrelextrema
+
+# Author: Ruslana Kruk
+# This module finds local minima and maxima of price series in O(n) for any order, for single series, many series
+# at once and bar by bar. Results match scipy argrelextrema with less_equal/greater_equal and mode='clip'.
+
+EXTREMA_REDUCERS = {"low": numpy.minimum, "high": numpy.maximum}
+
+
+def centered_window_extreme(values, order, kind):
+    """
+    Min ("low") or max ("high") over the window of order bars on each side of every bar, along the last axis.
+    The ends are padded with the edge values, which is the same as clipping the window.
+    Uses the van Herk/Gil-Werman block prefix/suffix scans: three passes whatever the order.
+    """
+    reducer = EXTREMA_REDUCERS[kind]
+    values = numpy.asarray(values, dtype=numpy.float64)
+    bar_count, window = values.shape[-1], 2 * order + 1
+    padded_length = bar_count + 2 * order
+    block_count = -(-padded_length // window)
+    padded = numpy.pad(values, [(0, 0)] * (values.ndim - 1) + [(order, block_count * window - bar_count - order)], mode='edge')
+
+    blocks = padded.reshape(values.shape[:-1] + (block_count, window))
+    prefix = reducer.accumulate(blocks, axis=-1).reshape(padded.shape)
+    suffix = numpy.flip(reducer.accumulate(numpy.flip(blocks, axis=-1), axis=-1), axis=-1).reshape(padded.shape)
+    return reducer(suffix[..., :bar_count], prefix[..., window - 1:window - 1 + bar_count])
+
+
+def local_extrema_mask(values, order, kind):
+    """
+    Boolean mask of bars that are <= ("low") or >= ("high") every bar within order bars on each side.
+    Args:
+    values (array): 1-D series or 2-D array of series x bars.
+    order (int): Number of bars on each side.
+    kind (str): "low" or "high".
+    Returns:
+    ndarray: Mask with the shape of values.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if values.shape[-1] == 0:
+        return numpy.zeros(values.shape, dtype=bool)
+    # A NaN anywhere in the window propagates to the window extreme and never compares equal
+    return values == centered_window_extreme(values, order, kind)
+
+
+def extreme_points(values, order, kind):
+    """
+    Returns values at local extremes and NaN elsewhere, with the shape of values.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    return numpy.where(local_extrema_mask(values, order, kind), values, numpy.nan)
+
+
+def segment_extreme_points(values, group_sizes, order, kind):
+    """
+    Same as extreme_points for consecutive series of different lengths stacked in one 1-D array.
+    Every series is padded with order copies of its edge values, so no window reaches into a neighbouring series.
+    Args:
+    values (array): Stacked series.
+    group_sizes (array): Length of every series, in stacking order.
+    order (int): Number of bars on each side.
+    kind (str): "low" or "high".
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    group_sizes = numpy.asarray(group_sizes)
+    group_sizes = group_sizes[group_sizes > 0]
+    if not len(values):
+        return values.copy()
+    starts = numpy.cumsum(group_sizes) - group_sizes
+    ends = starts + group_sizes - 1
+
+    # Source index of every padded element: order x first, the series, order x last
+    repeats = numpy.ones(len(values), dtype=numpy.int64)
+    repeats[starts] += order
+    repeats[ends] += order
+    padded = values[numpy.repeat(numpy.arange(len(values)), repeats)]
+    padded_positions = numpy.arange(len(values)) + (2 * numpy.arange(len(group_sizes)) + 1).repeat(group_sizes) * order
+
+    window_extremes = centered_window_extreme(padded, order, kind)
+    return numpy.where(values == window_extremes[padded_positions], values, numpy.nan)
+
+
+class StreamingExtremaDetector:
+    """
+    Confirms local extremes bar by bar. A bar is confirmed once order later bars have arrived;
+    flush confirms the last order bars with the window clipped at the end, as for a complete series.
+    The sliding window min and max are kept in monotonic deques, so every bar costs O(1) amortized.
+    """
+
+    def __init__(self, order):
+        self.order = order
+        self.bar_count = 0
+        self.values = deque(maxlen=2 * order + 2)
+        self.low_indexes, self.high_indexes = deque(), deque()
+        self.last_nan_index = -1
+
+    def push_to_window(self, index, value):
+        self.values.append(value)
+        if value != value:
+            self.last_nan_index = index
+            return
+        while self.low_indexes and self.value_at(self.low_indexes[-1]) > value:
+            self.low_indexes.pop()
+        self.low_indexes.append(index)
+        while self.high_indexes and self.value_at(self.high_indexes[-1]) < value:
+            self.high_indexes.pop()
+        self.high_indexes.append(index)
+
+    def value_at(self, index):
+        return self.values[index - (self.bar_count - len(self.values))]
+
+    def confirm(self, index, window_start):
+        # Drop indexes that left the window, then compare the bar with the window min and max
+        while self.low_indexes and self.low_indexes[0] < window_start:
+            self.low_indexes.popleft()
+        while self.high_indexes and self.high_indexes[0] < window_start:
+            self.high_indexes.popleft()
+        value = self.value_at(index)
+        if self.last_nan_index >= window_start or value != value:
+            return index, value, False, False
+        return index, value, value == self.value_at(self.low_indexes[0]), value == self.value_at(self.high_indexes[0])
+
+    def push(self, value):
+        """
+        Adds a bar and returns (index, value, is_low, is_high) for the bar order bars back, or None while too few bars.
+        """
+        self.bar_count += 1
+        self.push_to_window(self.bar_count - 1, float(value))
+        index = self.bar_count - 1 - self.order
+        if index < 0:
+            return None
+        return self.confirm(index, max(0, index - self.order))
+
+    def flush(self):
+        """
+        Returns (index, value, is_low, is_high) for the bars not yet confirmed, treating the series as complete.
+        """
+        first_index = max(0, self.bar_count - self.order)
+        return [self.confirm(index, max(0, index - self.order)) for index in range(first_index, self.bar_count)]
+
+
+def benchmark_local_extrema(series_count=2000, bar_count=500, orders=(3, 4, 5, 20), seed=0):
+    """
+    Checks results against argrelextrema and prints timings of both on a series x bars random-walk array.
+    Prices are rounded to whole cents so that ties between neighbouring bars occur.
+    """
+    rng = numpy.random.default_rng(seed)
+    prices = numpy.round(100 + numpy.cumsum(rng.normal(0, 0.3, (series_count, bar_count)), axis=1), 2)
+    prices[0, 10] = numpy.nan
+
+    for order in orders:
+        for kind, comparator in (("low", numpy.less_equal), ("high", numpy.greater_equal)):
+            start_time = time.perf_counter()
+            expected = numpy.zeros(prices.shape, dtype=bool)
+            for series_number, series in enumerate(prices):
+                expected[series_number, argrelextrema(series, comparator, order=order)[0]] = True
+            scipy_elapsed = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            mask = local_extrema_mask(prices, order, kind)
+            elapsed = time.perf_counter() - start_time
+
+            stacked = segment_extreme_points(prices[1:].ravel(), [bar_count] * (series_count - 1), order, kind)
+            detector, streamed = StreamingExtremaDetector(order), numpy.zeros(bar_count, dtype=bool)
+            for result in [detector.push(value) for value in prices[0]] + detector.flush():
+                if result is not None:
+                    streamed[result[0]] = result[2] if kind == "low" else result[3]
+
+            assert (mask == expected).all(), f"2-D mismatch for order {order} {kind}"
+            assert (~numpy.isnan(stacked) == expected[1:].ravel()).all(), f"segment mismatch for order {order} {kind}"
+            assert (streamed == expected[0]).all(), f"streaming mismatch for order {order} {kind}"
+            print(f"order {order:>2} {kind:<4}: argrelextrema {scipy_elapsed:.3f}s, 2-D {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    benchmark_local_extrema()
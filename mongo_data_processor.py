@@ -1,4 +1,7 @@
-﻿from datetime import datetime
+﻿import hashlib
+import json
+from datetime import datetime, timezone
+from pymongo import ASCENDING, UpdateOne
 from helpers_json import correct_datetime_fields, remove_extra_fields, deep_compare_json
 from scrape_helpers import db
 
@@ -10,18 +13,40 @@ collection_file_stacks = db["file_stacks"]
 collection_users = db["users"]
 collection_statistics = db["statistics"]
 collection_activity = db["activity"]
+collection_checkpoints = db["scrape_checkpoints"]
 
 # Field names
 field_date_create = "_scrape_date_create"
 field_date_update = "_scrape_date_update"
 field_update_status = "_scrape_status"
+field_content_hash = "_scrape_hash"
+work_field_prefix = "_scrape_"
 
 # Add work fields to the document
-def add_work_fields(document, add_create_date):
+def add_work_fields(document, add_create_date, content_hash):
     if add_create_date:
         document[field_date_create] = datetime.now()
     document[field_date_update] = datetime.now()
     document[field_update_status] = 0
+    document[field_content_hash] = content_hash
+
+# Serialize values json cannot handle; datetimes are cut to milliseconds and made naive UTC as MongoDB returns them
+def content_hash_default(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat(timespec="milliseconds")
+    return str(value)
+
+# Stable hash of the document content, ignoring the _scrape_* work fields
+def compute_content_hash(document):
+    content = {key: value for key, value in document.items() if not key.startswith(work_field_prefix)}
+    serialized = json.dumps(content, sort_keys=True, separators=(",", ":"), default=content_hash_default)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).hexdigest()
+
+# Create the (_id, _scrape_hash) index so hash lookups are covered by the index
+def ensure_content_hash_index(collection):
+    collection.create_index([("_id", ASCENDING), (field_content_hash, ASCENDING)], name="_id_scrape_hash")
 
 # Prepare file stack document by removing specific keys
 def prepare_fs_document(document):
@@ -32,10 +57,7 @@ def prepare_fs_document(document):
 
 # Write file stack data to MongoDB
 def write_fs_to_mongo(documents, counters):
-    for document in documents:
-        document_id = document["_id"]
-        existing_document = collection_file_stacks.find_one({"_id": document_id})
-        update_or_insert_document(existing_document, document, collection_file_stacks, counters, "fs")
+    bulk_update_or_insert_documents(documents, collection_file_stacks, counters, "fs")
 
 # Prepare user document by removing specific keys
 def prepare_user_document(document):
@@ -46,44 +68,119 @@ def prepare_user_document(document):
 
 # Write user data to MongoDB
 def write_user_to_mongo(document, counters):
-    user_id = document["_id"]
-    existing_document = collection_users.find_one({"_id": user_id})
-    update_or_insert_document(existing_document, document, collection_users, counters, "user")
+    bulk_update_or_insert_documents([document], collection_users, counters, "user")
 
 # Write statistics to MongoDB
 def write_statistic_to_mongo(documents, account_id, counters):
     for document in documents:
-        document_id = document["_id"]
         document["account_id"] = account_id
         correct_datetime_fields(document)
-        existing_document = collection_statistics.find_one({"_id": document_id})
-        update_or_insert_document(existing_document, document, collection_statistics, counters, "statistic")
+    bulk_update_or_insert_documents(documents, collection_statistics, counters, "statistic")
 
 # Write activity data to MongoDB and return the minimum date
 def write_activity_to_mongo(documents, account_id, counters):
     min_date = datetime.now()
     for document in documents:
-        document_id = document["_id"]
         document["account_id"] = account_id
         correct_datetime_fields(document)
-        existing_document = collection_activity.find_one({"_id": document_id})
-        if existing_document:
+    existing_documents = find_existing_documents(documents, collection_activity)
+    for document in documents:
+        if document["_id"] in existing_documents:
             if min_date > document["updated_at"]:
                 min_date = document["updated_at"]
-        update_or_insert_document(existing_document, document, collection_activity, counters, "activity")
+    bulk_update_or_insert_documents(documents, collection_activity, counters, "activity", existing_documents)
     return min_date
 
-# General function to update or insert document in MongoDB
-def update_or_insert_document(existing_document, new_document, collection, counters, counter_type):
+# Fetch _id and content hash of existing documents for a page with one $in query, keyed by _id.
+# Documents stored before the hash was introduced are loaded in full so they can still be deep compared.
+def find_existing_documents(documents, collection):
+    document_ids = [document["_id"] for document in documents]
+    if not document_ids:
+        return {}
+    existing_documents = {document["_id"]: document for document in
+                          collection.find({"_id": {"$in": document_ids}}, {field_content_hash: 1})}
+
+    legacy_ids = [document_id for document_id, document in existing_documents.items() if field_content_hash not in document]
+    if legacy_ids:
+        existing_documents.update({document["_id"]: document for document in collection.find({"_id": {"$in": legacy_ids}})})
+    return existing_documents
+
+# Build the upsert operation for a document, or None if it is unchanged.
+# An unchanged document stored before hashing only gets its _scrape_hash set, so hashes are migrated lazily.
+def prepare_upsert_operation(existing_document, new_document, counters, counter_type):
+    content_hash = compute_content_hash(new_document)
     if existing_document:
-        existing_document_clear = remove_extra_fields(existing_document, new_document)
-        if not deep_compare_json(existing_document_clear, new_document):
-            add_work_fields(new_document, add_create_date=False)
-            collection.update_one({"_id": new_document["_id"]}, {"$set": new_document}, upsert=True)
-            counters[f'{counter_type} Updated'] += 1
+        if field_content_hash in existing_document:
+            if existing_document[field_content_hash] == content_hash:
+                counters[f'{counter_type} Unchanged'] += 1
+                return None
         else:
-            counters[f'{counter_type} Unchanged'] += 1
+            existing_document_clear = remove_extra_fields(existing_document, new_document)
+            if deep_compare_json(existing_document_clear, new_document):
+                counters[f'{counter_type} Unchanged'] += 1
+                return UpdateOne({"_id": new_document["_id"]}, {"$set": {field_content_hash: content_hash}})
+        add_work_fields(new_document, add_create_date=False, content_hash=content_hash)
+        counters[f'{counter_type} Updated'] += 1
     else:
-        add_work_fields(new_document, add_create_date=True)
-        collection.update_one({"_id": new_document["_id"]}, {"$set": new_document}, upsert=True)
+        add_work_fields(new_document, add_create_date=True, content_hash=content_hash)
         counters[f'{counter_type} Inserted'] += 1
+    return UpdateOne({"_id": new_document["_id"]}, {"$set": new_document}, upsert=True)
+
+# Diff a page of documents in memory and send only the changed ones as one unordered bulk write
+def bulk_update_or_insert_documents(documents, collection, counters, counter_type, existing_documents=None):
+    if existing_documents is None:
+        existing_documents = find_existing_documents(documents, collection)
+
+    bulk_operations = []
+    for document in documents:
+        operation = prepare_upsert_operation(existing_documents.get(document["_id"]), document, counters, counter_type)
+        if operation is not None:
+            bulk_operations.append(operation)
+
+    if bulk_operations:
+        collection.bulk_write(bulk_operations, ordered=False)
+
+# General function to update or insert document in MongoDB
+def update_or_insert_document(existing_document, new_document, collection, counters, counter_type):
+    operation = prepare_upsert_operation(existing_document, new_document, counters, counter_type)
+    if operation is not None:
+        collection.bulk_write([operation])
+
+# Read the scrape checkpoint of an account and endpoint
+def read_checkpoint(account_id, endpoint):
+    return collection_checkpoints.find_one({"_id": f"{account_id}:{endpoint}"})
+
+# Commit the offset and the newest updated_at seen by a run that is still in progress
+def save_checkpoint_progress(account_id, endpoint, offset, run_high_water_mark):
+    collection_checkpoints.update_one({"_id": f"{account_id}:{endpoint}"},
+                                      {"$set": {"account_id": account_id, "endpoint": endpoint, "offset": offset,
+                                                "run_high_water_mark": run_high_water_mark, "status": "running",
+                                                field_date_update: datetime.now()}}, upsert=True)
+
+# Promote the newest updated_at of a finished run to the high-water mark and clear the resume offset
+def complete_checkpoint(account_id, endpoint, run_high_water_mark):
+    update = {"$set": {"account_id": account_id, "endpoint": endpoint, "offset": 0, "run_high_water_mark": None,
+                       "status": "complete", field_date_update: datetime.now()}}
+    if run_high_water_mark is not None:
+        update["$max"] = {"high_water_mark": run_high_water_mark}
+    collection_checkpoints.update_one({"_id": f"{account_id}:{endpoint}"}, update, upsert=True)
+
+# Backfill _scrape_hash for documents stored before content hashing was introduced.
+# Stored documents are the $set of prepared scraped documents, so hashing them without the _scrape_* work fields gives
+# the hash of the next scrape; a document that later lost a field just fails the hash check once and is rewritten.
+def backfill_content_hashes(collection, batch_size=1000):
+    ensure_content_hash_index(collection)
+    updated, bulk_operations = 0, []
+    for document in collection.find({field_content_hash: {"$exists": False}}).batch_size(batch_size):
+        bulk_operations.append(UpdateOne({"_id": document["_id"]}, {"$set": {field_content_hash: compute_content_hash(document)}}))
+        if len(bulk_operations) >= batch_size:
+            updated += collection.bulk_write(bulk_operations, ordered=False).modified_count
+            bulk_operations = []
+    if bulk_operations:
+        updated += collection.bulk_write(bulk_operations, ordered=False).modified_count
+    return updated
+
+# Setup and backfill command, run once per database: python mongo_data_processor.py
+if __name__ == "__main__":
+    for collection in [collection_file_stacks, collection_users, collection_statistics, collection_activity]:
+        print(f"{collection.name}: {backfill_content_hashes(collection)} documents hashed")
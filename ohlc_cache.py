@@ -0,0 +1,181 @@
+﻿import os
+import re
+from datetime import datetime, timedelta
+import numpy
+import pandas
+
+# Author: Ruslana Kruk
+# This module keeps a local columnar OHLC store: one append-only binary file per column, ticker and interval,
+# read back as memory-mapped NumPy arrays so reads by ticker and date range are zero-copy slices.
+
+CACHE_COLUMNS = {'DATE_TIME': numpy.dtype('<M8[ns]'), 'OPEN': numpy.dtype('<f8'), 'HIGH': numpy.dtype('<f8'),
+                 'LOW': numpy.dtype('<f8'), 'CLOSE': numpy.dtype('<f8'), 'VOLUME': numpy.dtype('<f8')}
+# Cached bars re-downloaded and compared on every update to detect splits and data corrections
+OVERLAP_BARS = 5
+PRICE_TOLERANCE = 1e-6
+PERIOD_UNITS = {'d': timedelta(days=1), 'wk': timedelta(weeks=1), 'mo': timedelta(days=30), 'y': timedelta(days=365)}
+
+
+def period_start(period, now=None):
+    """
+    Converts a yfinance period such as "180d", "1y" or "max" to its start datetime, or None for "max".
+    """
+    match = re.fullmatch(r'(\d+)(d|wk|mo|y)', period or 'max')
+    if match is None:
+        return None
+    return (now or datetime.now()) - int(match.group(1)) * PERIOD_UNITS[match.group(2)]
+
+
+class OhlcCache:
+    """
+    On-disk OHLC bars keyed by ticker and interval. Bars are appended after the last cached bar. The bar count is the
+    shortest column file, and DATE_TIME is written last, so an interrupted append leaves only longer files that the
+    next append truncates.
+    A ticker's files are rewritten only when re-downloaded overlap bars show corrected history.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def column_path(self, ticker, interval, column):
+        return os.path.join(self.directory, interval, ticker, f"{column}.bin")
+
+    def bar_count(self, ticker, interval):
+        bar_counts = []
+        for column, dtype in CACHE_COLUMNS.items():
+            path = self.column_path(ticker, interval, column)
+            bar_counts.append(os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0)
+        return min(bar_counts)
+
+    def read_columns(self, ticker, interval, start=None, end=None):
+        """
+        Returns a dict of column name to read-only memory-mapped arrays for bars with start <= DATE_TIME < end.
+        """
+        bar_count = self.bar_count(ticker, interval)
+        if bar_count == 0:
+            return {column: numpy.empty(0, dtype=dtype) for column, dtype in CACHE_COLUMNS.items()}
+        columns = {column: numpy.memmap(self.column_path(ticker, interval, column), dtype=dtype, mode='r', shape=(bar_count,))
+                   for column, dtype in CACHE_COLUMNS.items()}
+        dates = columns['DATE_TIME']
+        first = 0 if start is None else numpy.searchsorted(dates, numpy.datetime64(pandas.Timestamp(start)), side='left')
+        last = bar_count if end is None else numpy.searchsorted(dates, numpy.datetime64(pandas.Timestamp(end)), side='left')
+        return {column: values[first:last] for column, values in columns.items()}
+
+    def read_frame(self, ticker, interval, start=None, end=None):
+        """
+        Returns cached bars as a DataFrame with TICKER, INTERVAL, DATE_TIME, OPEN, HIGH, LOW, CLOSE, VOLUME columns.
+        """
+        prices_df = pandas.DataFrame(self.read_columns(ticker, interval, start, end))
+        prices_df.insert(0, 'TICKER', ticker)
+        prices_df.insert(1, 'INTERVAL', interval)
+        return prices_df[['TICKER', 'INTERVAL'] + list(CACHE_COLUMNS)]
+
+    def last_date(self, ticker, interval):
+        dates = self.read_columns(ticker, interval)['DATE_TIME']
+        return pandas.Timestamp(dates[-1]) if len(dates) else None
+
+    def append(self, ticker, interval, prices_df):
+        """
+        Appends the bars of prices_df newer than the last cached bar; returns the number of appended bars.
+        """
+        last_date = self.last_date(ticker, interval)
+        dates = pandas.to_datetime(prices_df['DATE_TIME']).to_numpy(dtype=CACHE_COLUMNS['DATE_TIME'])
+        new_rows = numpy.flatnonzero(dates > numpy.datetime64(last_date)) if last_date is not None else numpy.arange(len(dates))
+        if not len(new_rows):
+            return 0
+
+        os.makedirs(os.path.dirname(self.column_path(ticker, interval, 'DATE_TIME')), exist_ok=True)
+        bar_count = self.bar_count(ticker, interval)
+        for column in sorted(CACHE_COLUMNS, key=lambda column: column == 'DATE_TIME'):
+            dtype = CACHE_COLUMNS[column]
+            values = dates[new_rows] if column == 'DATE_TIME' else prices_df[column].to_numpy(dtype=dtype)[new_rows]
+            with open(self.column_path(ticker, interval, column), 'ab') as column_file:
+                # Drop the tail of an earlier interrupted append before adding the new bars
+                column_file.truncate(bar_count * dtype.itemsize)
+                column_file.write(numpy.ascontiguousarray(values).tobytes())
+        return len(new_rows)
+
+    def rewrite(self, ticker, interval, prices_df):
+        """
+        Replaces all cached bars of a ticker, e.g. after a split changed its history.
+        """
+        for column in CACHE_COLUMNS:
+            path = self.column_path(ticker, interval, column)
+            if os.path.exists(path):
+                os.remove(path)
+        return self.append(ticker, interval, prices_df)
+
+    def history_corrected(self, ticker, interval, ticker_df):
+        """
+        True when the last OVERLAP_BARS cached bars are missing from a download or have different prices.
+        """
+        cached = self.read_frame(ticker, interval).iloc[-OVERLAP_BARS:]
+        downloaded = ticker_df.set_index(pandas.to_datetime(ticker_df['DATE_TIME']))
+        if not cached['DATE_TIME'].isin(downloaded.index).all():
+            return True
+        price_columns = ['OPEN', 'HIGH', 'LOW', 'CLOSE']
+        return not numpy.allclose(downloaded.loc[cached['DATE_TIME'], price_columns].to_numpy(dtype=numpy.float64),
+                                  cached[price_columns].to_numpy(), rtol=PRICE_TOLERANCE, atol=0, equal_nan=True)
+
+    def cached_download(self, tickers, period, interval, download, offline=False):
+        """
+        Returns per-ticker frames for the period, downloading only bars from each ticker's last OVERLAP_BARS cached bars on.
+        Tickers missing from that download are downloaded for the whole period; their cache is kept if that is empty too.
+        The overlap is compared with the cache; a ticker with corrected history is downloaded for the whole period and rewritten.
+        The last downloaded bar may still be forming, so it is returned but not cached; the next call downloads it again.
+        Args:
+        tickers (list): Tickers to read.
+        period (str): yfinance period, also used for tickers that are not cached yet.
+        interval (str): Bar interval.
+        download (callable): download(tickers, period, interval, start=None) returning per-ticker frames.
+        offline (bool): Read the cache only.
+        Returns:
+        list: DataFrames with TICKER, INTERVAL, DATE_TIME, OPEN, HIGH, LOW, CLOSE, VOLUME columns.
+        """
+        forming_bars = {}
+        if not offline:
+            overlap_starts = {}
+            for ticker in tickers:
+                dates = self.read_columns(ticker, interval)['DATE_TIME']
+                if len(dates):
+                    overlap_starts[ticker] = pandas.Timestamp(dates[max(0, len(dates) - OVERLAP_BARS)])
+            new_tickers = [ticker for ticker in tickers if ticker not in overlap_starts]
+            # Tickers with the same overlap start are downloaded together, so a stale ticker does not widen the others' window
+            start_groups = {}
+            for ticker, overlap_start in overlap_starts.items():
+                start_groups.setdefault(overlap_start, []).append(ticker)
+            updates, downloaded_tickers = [], set()
+            for overlap_start, group_tickers in start_groups.items():
+                for ticker_df in download(group_tickers, period, interval, start=overlap_start):
+                    ticker_df = ticker_df.dropna(subset=['CLOSE'])
+                    if ticker_df.empty:
+                        continue
+                    ticker = ticker_df['TICKER'].iloc[0]
+                    downloaded_tickers.add(ticker)
+                    if self.history_corrected(ticker, interval, ticker_df):
+                        new_tickers.append(ticker)
+                    else:
+                        updates.append((self.append, ticker_df))
+            missing_tickers = [ticker for ticker in overlap_starts if ticker not in downloaded_tickers]
+            if missing_tickers:
+                print(f"OHLC cache {interval}: no bars downloaded for {', '.join(missing_tickers)}, downloading the whole period")
+                new_tickers += missing_tickers
+            if new_tickers:
+                updates += [(self.rewrite, ticker_df.dropna(subset=['CLOSE'])) for ticker_df in download(new_tickers, period, interval)]
+
+            for update, ticker_df in updates:
+                if ticker_df.empty:
+                    continue
+                ticker = ticker_df['TICKER'].iloc[0]
+                update(ticker, interval, ticker_df.iloc[:-1])
+                forming_bars[ticker] = ticker_df.iloc[-1:]
+
+        start = period_start(period)
+        tickers_prices = []
+        for ticker in tickers:
+            prices_df = self.read_frame(ticker, interval, start)
+            if ticker in forming_bars and (prices_df.empty or forming_bars[ticker]['DATE_TIME'].iloc[0] > prices_df['DATE_TIME'].iloc[-1]):
+                prices_df = pandas.concat([prices_df, forming_bars[ticker][prices_df.columns]], ignore_index=True)
+            if len(prices_df):
+                tickers_prices.append(prices_df)
+        return tickers_prices
@@ -1,7 +1,11 @@
 ﻿import redis
+import redis.asyncio
+import asyncio
+import bisect
+import random
 import time
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import threading
 import csv
 from datetime import datetime
@@ -9,6 +13,10 @@ import prettytable
 import os
 import platform
 import logging
+import sys
+import glob
+from queue import Empty, Queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Author: Ruslana Kruk 2022
 # This script measures and monitors the performance of Redis server connections.
@@ -24,43 +32,327 @@ ITERATIONS_PER_THREAD = 50
 redis1_params = {"host": "redis1-master", "port": 6379, "db": 0}
 redis2_params = {"host": "redis2-master", "port": 6379, "db": 0}
 
+# Benchmark settings
+BENCHMARK_OPERATIONS = 2000
+BENCHMARK_CONNECTIONS = 200
+BENCHMARK_BATCH_SIZES = [1, 10, 100]
+BENCHMARK_VALUE_SIZES = [16, 1024, 16384]
+
+# Load test settings
+LOAD_TARGET_RATES = [1000, 2500, 5000, 10000, 20000, 40000, 80000, 160000]
+LOAD_PROCESSES = os.cpu_count() or 1
+LOAD_CLIENTS_PER_PROCESS = 16
+LOAD_STEP_SECONDS = 10
+LOAD_KEY_SPACE = 100000
+LOAD_VALUE_SIZE = 128
+LOAD_READ_RATIO = 0.8
+ZIPF_EXPONENT = 0.99
+KNEE_P99_FACTOR = 2.0
+
+# Monitor settings
+PROBE_INTERVAL = 60
+PROBE_TIMEOUT = 5
+CSV_FILE_PREFIX = 'db_connect'
+CSV_FLUSH_ROWS = 20
+CSV_FLUSH_SECONDS = 30
+CSV_KEEP_FILES = 30
+
+# Metrics exporter settings
+EXPORTER_PORT = 9122
+EXPORTER_INTERVAL = 15
+EXPORTER_SAMPLES = 20
+EXPORTER_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+EXPORTER_INFO_FIELDS = {"instantaneous_ops_per_sec": "redis_instantaneous_ops_per_sec",
+                        "used_memory": "redis_used_memory_bytes",
+                        "connected_clients": "redis_connected_clients"}
+METRIC_HELP = {
+    "redis_probe_connect_latency_seconds": ("histogram", "Time to open a connection and PING"),
+    "redis_probe_operation_latency_seconds": ("histogram", "Latency of single read and write commands"),
+    "redis_probe_failures_total": ("counter", "Failed probe steps"),
+    "redis_instantaneous_ops_per_sec": ("gauge", "INFO instantaneous_ops_per_sec"),
+    "redis_used_memory_bytes": ("gauge", "INFO used_memory"),
+    "redis_connected_clients": ("gauge", "INFO connected_clients"),
+}
+
+# HDR-style latency histogram in microseconds: log-linear buckets with SUB_BUCKETS per power of two,
+# so percentiles are accurate to about 1.5% at any magnitude with constant memory.
+class LatencyHistogram:
+    SUB_BUCKET_BITS = 7
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.counts = {}
+        self.total_count = 0
+        self.max_value = 0
+        self.sum_value = 0
+
+    def bucket_index(self, value):
+        shift = max(0, value.bit_length() - self.SUB_BUCKET_BITS)
+        return shift, value >> shift
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1_000_000))
+        index = self.bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total_count += 1
+        self.sum_value += value
+        self.max_value = max(self.max_value, value)
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total_count += other.total_count
+        self.sum_value += other.sum_value
+        self.max_value = max(self.max_value, other.max_value)
+
+    # Value in microseconds at the given percentile (0-100)
+    def percentile(self, percentile):
+        if not self.total_count:
+            return 0
+        threshold, seen = self.total_count * percentile / 100, 0
+        for shift, sub_bucket in sorted(self.counts):
+            seen += self.counts[(shift, sub_bucket)]
+            if seen >= threshold:
+                return min(self.max_value, ((sub_bucket + 1) << shift) - 1)
+        return self.max_value
+
+    def summary(self):
+        return {"p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99), "max": self.max_value}
+
 def clear_screen():
     os.system('cls' if platform.system().lower() == "windows" else 'clear')
 
 def connect_to_redis(redis_params):
+    start_time = time.perf_counter()
+    client = redis.Redis(**redis_params)
     try:
-        start_time = time.time()
-        redis.Redis(**redis_params)
-        return time.time() - start_time, threading.current_thread().ident, True
+        client.ping()
+        return time.perf_counter() - start_time, threading.current_thread().ident, True
     except Exception as e:
         logging.error(f'Redis Connection error: {e}')
-        return time.time() - start_time, threading.current_thread().ident, False
+        return time.perf_counter() - start_time, threading.current_thread().ident, False
+    finally:
+        client.close()
 
-def write_read_redis_keys(redis_params):
+def write_read_redis_keys(redis_params, key_count=100, read_rounds=10):
     r = redis.Redis(**redis_params)
-    keys, values = [f"test_key_{i}" for i in range(100)], [f"test_value_{i}" for i in range(100)]
-    write_start_time = time.time()
+    keys, values = [f"test_key_{i}" for i in range(key_count)], [f"test_value_{i}" for i in range(key_count)]
+    write_start_time = time.perf_counter()
     for key, value in zip(keys, values):
         r.set(key, value)
-    write_time = time.time() - write_start_time
+    write_time = time.perf_counter() - write_start_time
 
-    read_start_time = time.time()
-    for _ in range(10):
+    read_start_time = time.perf_counter()
+    for _ in range(read_rounds):
         for key in keys:
             r.get(key)
-    read_time = (time.time() - read_start_time) / 1000
+    read_time = (time.perf_counter() - read_start_time) / (read_rounds * key_count)
+    r.close()
     return write_time, read_time
 
-def measure_connection_time(redis_params):
+# Compare opening a fresh connection for every PING against reusing a ConnectionPool.
+# Returns a dict of mode -> LatencyHistogram.
+def benchmark_connections(redis_params, connections=BENCHMARK_CONNECTIONS):
+    histograms = {"fresh connection": LatencyHistogram(), "pooled connection": LatencyHistogram()}
+    for _ in range(connections):
+        elapsed, _, success = connect_to_redis(redis_params)
+        if success:
+            histograms["fresh connection"].record(elapsed)
+
+    pool = redis.ConnectionPool(**redis_params)
+    try:
+        for _ in range(connections):
+            start_time = time.perf_counter()
+            redis.Redis(connection_pool=pool).ping()
+            histograms["pooled connection"].record(time.perf_counter() - start_time)
+    finally:
+        pool.disconnect()
+    return histograms
+
+# Benchmark single SET/GET when batch_size is None, otherwise pipelined and MSET/MGET batches of batch_size keys.
+# Every call is one histogram sample; returns a dict of mode -> (LatencyHistogram, ops/sec).
+def benchmark_commands(redis_params, batch_size, value_size, operations=BENCHMARK_OPERATIONS):
+    client = redis.Redis(connection_pool=redis.ConnectionPool(**redis_params))
+    value = b"x" * value_size
+    keys = [f"benchmark_key_{i}" for i in range(operations)]
+    batches = [keys[i:i + batch_size] for i in range(0, operations, batch_size)] if batch_size else []
+
+    def run_pipeline(command):
+        def call(batch):
+            pipeline = client.pipeline(transaction=False)
+            for key in batch:
+                if command == "set":
+                    pipeline.set(key, value)
+                else:
+                    pipeline.get(key)
+            pipeline.execute()
+        return call
+
+    if batch_size is None:
+        modes = {
+            "single SET": (keys, lambda key: client.set(key, value)),
+            "single GET": (keys, lambda key: client.get(key)),
+        }
+    else:
+        modes = {
+            f"pipeline SET x{batch_size}": (batches, run_pipeline("set")),
+            f"pipeline GET x{batch_size}": (batches, run_pipeline("get")),
+            f"MSET x{batch_size}": (batches, lambda batch: client.mset({key: value for key in batch})),
+            f"MGET x{batch_size}": (batches, lambda batch: client.mget(batch)),
+        }
+
+    results = {}
+    try:
+        for mode, (calls, command) in modes.items():
+            histogram, start_time = LatencyHistogram(), time.perf_counter()
+            for call_argument in calls:
+                call_start_time = time.perf_counter()
+                command(call_argument)
+                histogram.record(time.perf_counter() - call_start_time)
+            results[mode] = (histogram, operations / (time.perf_counter() - start_time))
+        client.delete(*keys)
+    finally:
+        client.connection_pool.disconnect()
+    return results
+
+# Run the connection and command benchmarks against one Redis host and print p50/p95/p99/max latencies in microseconds.
+def run_benchmark(redis_params, batch_sizes=BENCHMARK_BATCH_SIZES, value_sizes=BENCHMARK_VALUE_SIZES):
+    table = prettytable.PrettyTable()
+    table.field_names = ["Redis Host", "Mode", "Value Size", "Ops/sec", "p50 us", "p95 us", "p99 us", "Max us"]
+    rows = []
+    for mode, histogram in benchmark_connections(redis_params).items():
+        rows.append([redis_params['host'], mode, "-", "-", *histogram.summary().values()])
+    for value_size in value_sizes:
+        # Single SET/GET do not depend on the batch size, so they run once per value size
+        for batch_size in [None, *batch_sizes]:
+            for mode, (histogram, ops_per_second) in benchmark_commands(redis_params, batch_size, value_size).items():
+                rows.append([redis_params['host'], mode, value_size, f"{ops_per_second:.0f}", *histogram.summary().values()])
+    for row in rows:
+        table.add_row(row)
+    print(table)
+    return rows
+
+def zipfian_cumulative_weights(key_space, exponent=ZIPF_EXPONENT):
+    total, weights = 0.0, []
+    for rank in range(1, key_space + 1):
+        total += 1 / rank ** exponent
+        weights.append(total)
+    return [weight / total for weight in weights]
+
+def key_picker(key_space, distribution, rng):
+    if distribution == "zipfian":
+        cumulative_weights = zipfian_cumulative_weights(key_space)
+        return lambda: min(bisect.bisect_left(cumulative_weights, rng.random()), key_space - 1)
+    return lambda: rng.randrange(key_space)
+
+# Open-loop asyncio clients: every client sends at its own fixed rate and latency is measured from the scheduled
+# send time, so queueing behind a saturated server shows up in the percentiles instead of lowering the offered load.
+async def load_clients(redis_params, rate_per_client, clients, duration, read_ratio, key_space, distribution, value_size, seed):
+    client = redis.asyncio.Redis(**redis_params, max_connections=clients)
+    histogram, errors, rng = LatencyHistogram(), 0, random.Random(seed)
+    next_key, value = key_picker(key_space, distribution, rng), b"x" * value_size
+    interval, start_time = 1 / rate_per_client, time.perf_counter() + 0.1
+
+    async def run_client(client_index):
+        nonlocal errors
+        operation_index = 0
+        while True:
+            scheduled_time = start_time + client_index * interval / clients + operation_index * interval
+            if scheduled_time - start_time >= duration:
+                return
+            delay = scheduled_time - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            key = f"load_key_{next_key()}"
+            try:
+                if rng.random() < read_ratio:
+                    await client.get(key)
+                else:
+                    await client.set(key, value)
+                histogram.record(time.perf_counter() - scheduled_time)
+            except Exception as e:
+                errors += 1
+                logging.error(f'Redis load error: {e}')
+            operation_index += 1
+
+    try:
+        await asyncio.gather(*[run_client(client_index) for client_index in range(clients)])
+    finally:
+        await client.aclose()
+    return histogram, errors
+
+def load_worker(redis_params, rate_per_client, clients, duration, read_ratio, key_space, distribution, value_size, seed):
+    return asyncio.run(load_clients(redis_params, rate_per_client, clients, duration, read_ratio, key_space,
+                                    distribution, value_size, seed))
+
+def preload_keys(redis_params, key_space, value_size, batch_size=1000):
+    client = redis.Redis(**redis_params)
+    value = b"x" * value_size
+    for start in range(0, key_space, batch_size):
+        client.mset({f"load_key_{i}": value for i in range(start, min(start + batch_size, key_space))})
+    client.close()
+
+# Return the highest step that still kept up with its target rate with p99 within p99_factor times the lowest p99
+# of the curve, i.e. the point after which p99 latency climbs. Single noisy steps at low load do not end the search.
+def find_knee(curve, p99_factor=KNEE_P99_FACTOR):
+    if not curve:
+        return None
+    baseline_p99, knee = max(1, min(step["p99"] for step in curve)), curve[0]
+    for step in curve:
+        if step["achieved"] < step["target"] * 0.95:
+            break
+        if step["p99"] <= baseline_p99 * p99_factor:
+            knee = step
+    return knee
+
+# Step through increasing target ops/sec with workers spread across processes and asyncio clients in each process.
+# Returns the throughput-versus-latency curve and its knee point.
+def run_load_test(redis_params, target_rates=LOAD_TARGET_RATES, processes=LOAD_PROCESSES,
+                  clients_per_process=LOAD_CLIENTS_PER_PROCESS, step_seconds=LOAD_STEP_SECONDS, read_ratio=LOAD_READ_RATIO,
+                  distribution="uniform", key_space=LOAD_KEY_SPACE, value_size=LOAD_VALUE_SIZE):
+    preload_keys(redis_params, key_space, value_size)
+    curve = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for target_rate in target_rates:
+            rate_per_client = target_rate / (processes * clients_per_process)
+            futures = [executor.submit(load_worker, redis_params, rate_per_client, clients_per_process, step_seconds,
+                                       read_ratio, key_space, distribution, value_size, seed)
+                       for seed in range(processes)]
+            histogram, errors, start_time = LatencyHistogram(), 0, time.perf_counter()
+            for future in futures:
+                worker_histogram, worker_errors = future.result()
+                histogram.merge(worker_histogram)
+                errors += worker_errors
+            achieved = histogram.total_count / max(step_seconds, time.perf_counter() - start_time - 0.1)
+            curve.append({"target": target_rate, "achieved": round(achieved), "errors": errors, **histogram.summary()})
+            print(f"{redis_params['host']} | target {target_rate} ops/sec | achieved {achieved:.0f} | p99 {curve[-1]['p99']} us")
+
+    table = prettytable.PrettyTable()
+    table.field_names = ["Redis Host", "Target Ops/sec", "Achieved Ops/sec", "Errors", "p50 us", "p95 us", "p99 us", "Max us"]
+    for step in curve:
+        table.add_row([redis_params['host'], step["target"], step["achieved"], step["errors"],
+                       step["p50"], step["p95"], step["p99"], step["max"]])
+    print(table)
+    knee = find_knee(curve)
+    print(f"{redis_params['host']} knee point: {knee['achieved']} ops/sec at p99 {knee['p99']} us")
+    return curve, knee
+
+def measure_connection_time(redis_params, progress=True):
     with ThreadPoolExecutor(max_workers=THREADS) as executor:
         results = list(tqdm(executor.map(lambda _: connect_to_redis(redis_params), range(ITERATIONS_PER_THREAD * THREADS)),
-                            total=ITERATIONS_PER_THREAD * THREADS, desc=f"Measuring Redis connection times for {redis_params['host']}"))
+                            total=ITERATIONS_PER_THREAD * THREADS, desc=f"Measuring Redis connection times for {redis_params['host']}",
+                            disable=not progress))
 
     times, successes, failures = [result[0] for result in results], sum(result[2] for result in results), THREADS * ITERATIONS_PER_THREAD - sum(result[2] for result in results)
     average_time = sum(times) / len(times)
     failure_percentage = (failures / (successes + failures)) * 100
 
-    write_time, read_time = write_read_redis_keys(redis_params)
+    try:
+        write_time, read_time = write_read_redis_keys(redis_params)
+        write_time, read_time = f"{write_time:.6f}", f"{read_time:.6f}"
+    except Exception as e:
+        logging.error(f'Redis read/write error: {e}')
+        write_time = read_time = "-"
 
     return {
         "Datetime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -70,35 +362,242 @@ def measure_connection_time(redis_params):
         "Success": successes,
         "Failures": failures,
         "Failure %": f"{failure_percentage:.2f}%",
-        "Write Time": f"{write_time:.6f}",
-        "Average Read Time": f"{read_time:.6f}"
+        "Write Time": write_time,
+        "Average Read Time": read_time
     }
 
 def measure_redis_servers(*redis_params):
-    return [measure_connection_time(params) for params in redis_params]
+    with ThreadPoolExecutor(max_workers=len(redis_params)) as executor:
+        return list(executor.map(lambda params: measure_connection_time(params, progress=False), redis_params))
 
-def write_to_csv(data, filename='db_connect.csv'):
-    headers = data[0].keys()
-    with open(filename, 'a', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=headers)
-        for row in data:
-            writer.writerow(row)
+# Buffers result rows and appends them from a background thread to one CSV file per day,
+# flushing every CSV_FLUSH_ROWS rows or CSV_FLUSH_SECONDS seconds and keeping the newest CSV_KEEP_FILES files.
+class BufferedCsvWriter:
+    def __init__(self, prefix=CSV_FILE_PREFIX):
+        self.prefix = prefix
+        self.rows = Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
-def print_table(data):
+    def write(self, row):
+        self.rows.put(row)
+
+    def close(self):
+        self.rows.put(None)
+        self.thread.join()
+
+    def flush(self, buffer):
+        by_file = {}
+        for row in buffer:
+            by_file.setdefault(f"{self.prefix}_{row['Datetime'][:10].replace('-', '')}.csv", []).append(row)
+        for filename, rows in by_file.items():
+            new_file = not os.path.exists(filename)
+            with open(filename, 'a', newline='') as file:
+                writer = csv.DictWriter(file, fieldnames=rows[0].keys())
+                if new_file:
+                    writer.writeheader()
+                writer.writerows(rows)
+        for old_file in sorted(glob.glob(f"{self.prefix}_*.csv"))[:-CSV_KEEP_FILES]:
+            os.remove(old_file)
+        buffer.clear()
+
+    def run(self):
+        buffer, last_flush = [], time.monotonic()
+        while True:
+            try:
+                row = self.rows.get(timeout=1)
+            except Empty:
+                row = ()
+            if row is None:
+                self.flush(buffer)
+                return
+            if row:
+                buffer.append(row)
+            if buffer and (len(buffer) >= CSV_FLUSH_ROWS or time.monotonic() - last_flush >= CSV_FLUSH_SECONDS):
+                self.flush(buffer)
+                last_flush = time.monotonic()
+
+# Probe one host on a fixed-rate schedule shared by all hosts. Ticks are computed from start_time so drift does not
+# accumulate; a probe that overruns skips the ticks it missed without delaying the other hosts.
+def probe_host(redis_params, start_time, interval, results, stop_event):
+    probe_params = {"socket_connect_timeout": PROBE_TIMEOUT, "socket_timeout": PROBE_TIMEOUT, **redis_params}
+    tick = 0
+    while not stop_event.wait(max(0.0, start_time + tick * interval - time.monotonic())):
+        try:
+            results.put(measure_connection_time(probe_params, progress=False))
+        except Exception as e:
+            logging.error(f'Redis probe error for {redis_params["host"]}: {e}')
+        tick = max(tick + 1, int((time.monotonic() - start_time) // interval) + 1)
+
+def format_table(data):
     table = prettytable.PrettyTable()
     table.field_names = data[0].keys()
     for row in data:
         table.add_row([row[key] for key in table.field_names])
-    print(table)
+    return table.get_string()
 
-last_results = []
+def print_table(data):
+    print(format_table(data))
+
+def redraw_in_place(text, previous_line_count):
+    if previous_line_count:
+        sys.stdout.write(f"\033[{previous_line_count}F")
+    sys.stdout.write("".join(f"{line}\033[K\n" for line in text.splitlines()))
+    sys.stdout.flush()
+    return len(text.splitlines())
 
-while True:
-    results = measure_redis_servers(redis1_params, redis2_params)
-    last_results.append(results)
-    if len(last_results) > 60:
-        last_results.pop(0)
+def monitor_redis_servers(hosts=(redis1_params, redis2_params), interval=PROBE_INTERVAL):
+    results, stop_event, csv_writer = Queue(), threading.Event(), BufferedCsvWriter()
+    start_time = time.monotonic()
+    probes = [threading.Thread(target=probe_host, args=(params, start_time, interval, results, stop_event), daemon=True)
+              for params in hosts]
+    for probe in probes:
+        probe.start()
+
+    latest, line_count = {}, 0
     clear_screen()
-    print_table(last_results)
-    write_to_csv(results)
-    time.sleep(60)
+    try:
+        while True:
+            result = results.get()
+            latest[result["Redis Host"]] = result
+            csv_writer.write(result)
+            line_count = redraw_in_place(format_table(list(latest.values())), line_count)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        csv_writer.close()
+
+# Thread-safe store of histograms, counters and gauges keyed by metric name and labels,
+# rendered in the Prometheus text exposition format.
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms, self.counters, self.gauges = {}, {}, {}
+
+    def observe(self, name, labels, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault((name, labels), [[0] * len(EXPORTER_BUCKETS), 0.0, 0])
+            index = bisect.bisect_left(EXPORTER_BUCKETS, seconds)
+            if index < len(EXPORTER_BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + amount
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def render(self):
+        def label_string(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}" if pairs else ""
+
+        with self.lock:
+            samples = {}
+            for (name, labels), (bucket_counts, total, count) in self.histograms.items():
+                cumulative, lines = 0, samples.setdefault(name, [])
+                for bound, bucket_count in zip(EXPORTER_BUCKETS, bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{label_string(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{label_string(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{label_string(labels)} {total}")
+                lines.append(f"{name}_count{label_string(labels)} {count}")
+            for (name, labels), value in {**self.counters, **self.gauges}.items():
+                samples.setdefault(name, []).append(f"{name}{label_string(labels)} {value}")
+
+        output = []
+        for name, lines in samples.items():
+            metric_type, help_text = METRIC_HELP[name]
+            output += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}", *lines]
+        return "\n".join(output) + "\n"
+
+def collect_host_metrics(redis_params, registry, samples=EXPORTER_SAMPLES):
+    host = (("host", redis_params["host"]),)
+    probe_params = {"socket_connect_timeout": PROBE_TIMEOUT, "socket_timeout": PROBE_TIMEOUT, **redis_params}
+    for _ in range(samples):
+        elapsed, _, success = connect_to_redis(probe_params)
+        if success:
+            registry.observe("redis_probe_connect_latency_seconds", host, elapsed)
+        else:
+            registry.inc("redis_probe_failures_total", host + (("stage", "connect"),))
+
+    client = redis.Redis(**probe_params)
+    try:
+        for i in range(samples):
+            for operation, command in (("write", lambda: client.set(f"exporter_key_{i}", i)), ("read", lambda: client.get(f"exporter_key_{i}"))):
+                start_time = time.perf_counter()
+                try:
+                    command()
+                    registry.observe("redis_probe_operation_latency_seconds", host + (("operation", operation),), time.perf_counter() - start_time)
+                except Exception as e:
+                    logging.error(f'Redis exporter {operation} error: {e}')
+                    registry.inc("redis_probe_failures_total", host + (("stage", operation),))
+        try:
+            info = client.info()
+            for field, metric in EXPORTER_INFO_FIELDS.items():
+                if field in info:
+                    registry.set(metric, host, info[field])
+        except Exception as e:
+            logging.error(f'Redis exporter INFO error: {e}')
+            registry.inc("redis_probe_failures_total", host + (("stage", "info"),))
+    finally:
+        client.close()
+
+def exporter_loop(redis_params, registry, interval, stop_event):
+    start_time, tick = time.monotonic(), 0
+    while not stop_event.wait(max(0.0, start_time + tick * interval - time.monotonic())):
+        try:
+            collect_host_metrics(redis_params, registry)
+        except Exception as e:
+            logging.error(f'Redis exporter error for {redis_params["host"]}: {e}')
+        tick = max(tick + 1, int((time.monotonic() - start_time) // interval) + 1)
+
+# Serve /metrics over HTTP; one background thread per host refreshes the measurements, so a scrape only renders them.
+# Returns the server and the stop event; call server.shutdown() and stop_event.set() to stop.
+def serve_metrics(hosts=(redis1_params, redis2_params), port=EXPORTER_PORT, interval=EXPORTER_INTERVAL, bind="127.0.0.1"):
+    registry, stop_event = MetricsRegistry(), threading.Event()
+    for params in hosts:
+        threading.Thread(target=exporter_loop, args=(params, registry, interval, stop_event), daemon=True).start()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((bind, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stop_event
+
+# Usage: python redis_performance_monitor.py [benchmark [host] [port] | load [uniform|zipfian] | exporter [port]]
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "exporter":
+        server, stop_event = serve_metrics(port=int(sys.argv[2]) if len(sys.argv) > 2 else EXPORTER_PORT)
+        try:
+            stop_event.wait()
+        except KeyboardInterrupt:
+            stop_event.set()
+            server.shutdown()
+    elif len(sys.argv) > 1 and sys.argv[1] == "load":
+        for params in [redis1_params, redis2_params]:
+            run_load_test(params, distribution=sys.argv[2] if len(sys.argv) > 2 else "uniform")
+    elif len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        host = sys.argv[2] if len(sys.argv) > 2 else "localhost"
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else 6379
+        run_benchmark({"host": host, "port": port, "db": 0})
+    else:
+        monitor_redis_servers()
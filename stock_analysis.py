@@ -6,15 +6,31 @@ import yfinance as yf
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from scipy.signal import argrelextrema
+from local_extrema import extreme_points
+from ohlc_cache import OhlcCache
 
 # Configuration for grid line style in plots
 GRID_LINE_STYLE = '--'
 GRID_LINE_WIDTH = 0.1
 GRID_LINE_COLOR = 'blue'
 
-# Download stock data for a specified stock over a given period and interval
-stock_data = yf.download('PLTR', interval="1d", period="180d")
+# Local OHLC cache directory; only bars newer than the cached ones are downloaded
+OHLC_CACHE_DIRECTORY = 'ohlc_cache'
+
+# Download one or more tickers in the cache layout: TICKER, INTERVAL, DATE_TIME, OPEN, HIGH, LOW, CLOSE, VOLUME
+def download_prices(tickers, period, interval, start=None):
+    download_range = {'start': start} if start is not None else {'period': period}
+    tickers_prices = []
+    for ticker in tickers:
+        ticker_df = yf.download(ticker, interval=interval, multi_level_index=False, **download_range)
+        ticker_df.columns = ticker_df.columns.str.upper()
+        tickers_prices.append(ticker_df.assign(TICKER=ticker, INTERVAL=interval, DATE_TIME=ticker_df.index.tz_localize(None))
+                              .reset_index(drop=True)[['TICKER', 'INTERVAL', 'DATE_TIME', 'OPEN', 'HIGH', 'LOW', 'CLOSE', 'VOLUME']])
+    return tickers_prices
+
+# Read stock data for a specified stock over a given period and interval through the cache
+prices = OhlcCache(OHLC_CACHE_DIRECTORY).cached_download(['PLTR'], "180d", "1d", download_prices)[0]
+stock_data = prices.set_index('DATE_TIME').rename(columns=str.capitalize)
 
 # Identifying local minima and maxima using shifts
 stock_data['local_min'] = stock_data.Close[(stock_data.Close.shift(1) > stock_data.Close) & (stock_data.Close.shift(-1) > stock_data.Close)]
@@ -22,8 +38,9 @@ stock_data['local_max'] = stock_data.Close[(stock_data.Close.shift(1) < stock_da
 
 # Function to plot stock data with local minima and maxima
 def plot_stock_data(stock_df, order_for_extrema, ax, label):
-    local_minima = stock_df.iloc[argrelextrema(stock_df.Close.values, np.less_equal, order=order_for_extrema)[0]]['Close']
-    local_maxima = stock_df.iloc[argrelextrema(stock_df.Close.values, np.greater_equal, order=order_for_extrema)[0]]['Close']
+    close_prices = np.ravel(stock_df['Close'].to_numpy())
+    local_minima = extreme_points(close_prices, order_for_extrema, "low")
+    local_maxima = extreme_points(close_prices, order_for_extrema, "high")
 
     ax.scatter(stock_df.index, local_minima, c='r')
     ax.scatter(stock_df.index, local_maxima, c='g')
@@ -1,10 +1,114 @@
-﻿import numpy
-from scipy.signal import argrelextrema
-from stockstats import StockDataFrame
+﻿import time
+import numpy
+import pandas
+from scipy.signal import lfilter
+from local_extrema import extreme_points, segment_extreme_points
 
 # Author: Ruslana Kruk
 # This module extends OHLC data with additional technical indicators like ATR, TR, and others.
 
+# Indicator periods and the number of bars on each side used to find extreme points
+ATR_PERIODS = [5, 12, 24]
+VOLUME_AVG_PERIODS = [5, 12, 24]
+EXTREME_BAR_COUNT = 4
+
+OHLCV_COLUMNS = ['OPEN', 'CLOSE', 'HIGH', 'LOW', 'VOLUME']
+PREV_COLUMNS = ['PREV_OPEN', 'PREV_CLOSE', 'PREV_HIGH', 'PREV_LOW', 'PREV_VOLUME']
+
+
+def drop_empty_volume_rows(ohlc_df):
+    """
+    Drops rows with zero or missing VOLUME and replaces remaining NaNs with 0.
+    """
+    return ohlc_df.replace(0, numpy.nan).dropna(subset=["VOLUME"]).replace(numpy.nan, 0)
+
+
+def smoothed_moving_average(values, period, numerator=0.0, count=0):
+    """
+    SMMA with the same weights as pandas ewm(alpha=1/period, adjust=True), computed with one linear filter pass.
+    Args:
+    values (ndarray): float64 input values.
+    period (int): SMMA period.
+    numerator (float): Weighted sum carried over from previous bars (incremental mode).
+    count (int): Number of previous bars (incremental mode).
+    Returns:
+    tuple: (SMMA values, weighted sum after the last value).
+    """
+    decay = 1.0 - 1.0 / period
+    weighted_sums = lfilter([1.0], [1.0, -decay], values, zi=[decay * numerator])[0]
+    weights = (1.0 - decay ** (count + numpy.arange(1, len(values) + 1))) * period
+    return weighted_sums / weights, (weighted_sums[-1] if len(values) else numerator)
+
+
+def rolling_mean(values, period, history=()):
+    """
+    Rolling mean with min_periods=1, using up to period - 1 values of history before the first value.
+    """
+    history = numpy.asarray(history, dtype=numpy.float64)[-(period - 1):] if period > 1 else numpy.empty(0)
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(numpy.concatenate((history, values)))))
+    ends = numpy.arange(len(history) + 1, len(cumulative))
+    starts = numpy.maximum(ends - period, 0)
+    return (cumulative[ends] - cumulative[starts]) / (ends - starts)
+
+
+def compute_indicator_arrays(ohlcv, state=None):
+    """
+    Computes TR, ATR, volume averages, PREV_* shifts and change columns on contiguous float64 arrays.
+    Args:
+    ohlcv (ndarray): 5 x N float64 array of OPEN, CLOSE, HIGH, LOW, VOLUME.
+    state (dict): Tail state of earlier bars from indicator_tail_state, or None to start from the first bar.
+    Returns:
+    tuple: (dict of column name to array, tail state after the last bar).
+    """
+    open_, close, high, low, volume = ohlcv
+    bar_count = ohlcv.shape[1]
+    state = state or {"rows": 0, "prev": [numpy.nan] * 5, "atr_sums": {}, "volumes": []}
+
+    prev = numpy.empty_like(ohlcv)
+    if bar_count:
+        prev[:, 0] = state["prev"]
+        prev[:, 1:] = ohlcv[:, :-1]
+    prev_open, prev_close = prev[0], prev[1]
+
+    columns = {name: prev[i] for i, name in enumerate(PREV_COLUMNS)}
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        columns['CHANGE_OPEN_PRICE'] = open_ - prev_close
+        columns['CHANGE_OPEN_PERCENT'] = columns['CHANGE_OPEN_PRICE'] / close * 100
+        columns['CHANGE_PRICE'] = close - prev_close
+        columns['CHANGE_PERCENT'] = columns['CHANGE_PRICE'] / prev_close * 100
+    columns['TR'] = high - low
+
+    # ATR uses the full true range; the first bar has no previous close and uses its own close
+    atr_prev_close = prev_close.copy()
+    if state["rows"] == 0 and bar_count:
+        atr_prev_close[0] = close[0]
+    true_range = numpy.maximum(high - low, numpy.maximum(numpy.abs(high - atr_prev_close), numpy.abs(low - atr_prev_close)))
+    true_range = numpy.nan_to_num(true_range)
+
+    atr_sums = {}
+    for period in ATR_PERIODS:
+        columns[f'ATR_{period}'], atr_sums[period] = smoothed_moving_average(
+            true_range, period, state["atr_sums"].get(period, 0.0), state["rows"])
+    for period in VOLUME_AVG_PERIODS:
+        columns[f'VOL_AVG_{period}'] = numpy.round(rolling_mean(volume, period, state["volumes"]), 0)
+
+    new_state = {
+        "rows": state["rows"] + bar_count,
+        "prev": ohlcv[:, -1].tolist() if bar_count else state["prev"],
+        "atr_sums": atr_sums,
+        "volumes": numpy.concatenate((state["volumes"], volume))[-(max(VOLUME_AVG_PERIODS) - 1):].tolist(),
+    }
+    return columns, new_state
+
+
+def finalize_frame(ohlc_df, columns):
+    """
+    Adds all indicator columns in one concat, replaces NaN with 0 and rounds to 2 decimals.
+    """
+    result = pandas.concat([ohlc_df, pandas.DataFrame(columns, index=ohlc_df.index)], axis=1)
+    return result.replace(numpy.nan, 0).round(2)
+
+
 def add_technical_indicators(ohlc_df):
     """
     Extends OHLC dataframe with technical indicators like ATR, TR, etc.
@@ -14,41 +118,216 @@ def add_technical_indicators(ohlc_df):
     DataFrame: Extended OHLC dataframe with additional technical indicators.
     """
     # Handle Volume zero values and NaNs
-    ohlc_df = ohlc_df.replace(0, numpy.nan).dropna(subset=["VOLUME"]).replace(numpy.nan, 0)
-    
-    # Add additional columns for calculations
+    ohlc_df = drop_empty_volume_rows(ohlc_df)
     data_length = len(ohlc_df)
-    ohlc_df['ROW_NUM_ACS'] = numpy.arange(data_length) + 1
-    ohlc_df['ROW_NUM_DESC'] = data_length - numpy.arange(data_length)
-    ohlc_df[['PREV_OPEN', 'PREV_CLOSE', 'PREV_HIGH', 'PREV_LOW', 'PREV_VOLUME']] = ohlc_df[['OPEN', 'CLOSE', 'HIGH', 'LOW', 'VOLUME']].shift(1)
-    ohlc_df['CHANGE_OPEN_PRICE'] = ohlc_df['OPEN'] - ohlc_df['PREV_CLOSE']
-    ohlc_df['CHANGE_OPEN_PERCENT'] = (ohlc_df['CHANGE_OPEN_PRICE'] / ohlc_df['CLOSE']) * 100
-    ohlc_df['CHANGE_PRICE'] = ohlc_df['CLOSE'] - ohlc_df['PREV_CLOSE']
-    ohlc_df['CHANGE_PERCENT'] = (ohlc_df['CHANGE_PRICE'] / ohlc_df['PREV_CLOSE']) * 100
-
-    # Retype data for stockstats
-    stocks = StockDataFrame.retype(ohlc_df[['OPEN', 'CLOSE', 'HIGH', 'LOW', 'VOLUME']])
-    
-    # Calculate True Range and Average True Range
-    ohlc_df['TR'] = ohlc_df['HIGH'] - ohlc_df['LOW']
-    for period in [5, 12, 24]:
-        ohlc_df[f'ATR_{period}'] = stocks[f'atr_{period}'].fillna(0)
-
-    # Calculate Volume Averages
-    for period in [5, 12, 24]:
-        ohlc_df[f'VOL_AVG_{period}'] = stocks[f'volume_{period}_sma'].fillna(0).round(0)
+
+    ohlcv = numpy.ascontiguousarray(ohlc_df[OHLCV_COLUMNS].to_numpy(dtype=numpy.float64).T)
+    indicator_columns, _ = compute_indicator_arrays(ohlcv)
+
+    columns = {'ROW_NUM_ACS': numpy.arange(data_length) + 1, 'ROW_NUM_DESC': data_length - numpy.arange(data_length)}
+    columns.update(indicator_columns)
 
     # Find Extremes Points
-    bar_count = 4
-    ohlc_df['EXTREME_LOW'] = ohlc_df.iloc[argrelextrema(ohlc_df.LOW.values, numpy.less_equal, order=bar_count)[0]]['LOW']
-    ohlc_df['EXTREME_HIGH'] = ohlc_df.iloc[argrelextrema(ohlc_df.HIGH.values, numpy.greater_equal, order=bar_count)[0]]['HIGH']
+    columns['EXTREME_LOW'] = extreme_points(ohlcv[3], EXTREME_BAR_COUNT, "low")
+    columns['EXTREME_HIGH'] = extreme_points(ohlcv[2], EXTREME_BAR_COUNT, "high")
 
     # Mark Last Row
-    ohlc_df['IS_LAST'] = 0
-    if data_length > 0:
-        ohlc_df.at[ohlc_df.index[-1], 'IS_LAST'] = 1
+    columns['IS_LAST'] = (numpy.arange(data_length) == data_length - 1).astype(numpy.int64)
+
+    return finalize_frame(ohlc_df, columns)
+
+
+def indicator_tail_state(ohlc_df, initial_state=None):
+    """
+    Computes the tail state needed to append bars to an already processed OHLC dataframe.
+    Args:
+    ohlc_df (DataFrame): The raw OHLC dataframe that add_technical_indicators was applied to.
+    initial_state (dict): State before the first bar of ohlc_df when it is only the tail of the history.
+    Returns:
+    dict: Tail state for append_technical_indicators.
+    """
+    ohlc_df = drop_empty_volume_rows(ohlc_df)
+    ohlcv = numpy.ascontiguousarray(ohlc_df[OHLCV_COLUMNS].to_numpy(dtype=numpy.float64).T)
+    _, state = compute_indicator_arrays(ohlcv, initial_state)
+    state["lows"] = ohlcv[3, -2 * EXTREME_BAR_COUNT:].tolist()
+    state["highs"] = ohlcv[2, -2 * EXTREME_BAR_COUNT:].tolist()
+    state["index"] = list(ohlc_df.index[-EXTREME_BAR_COUNT:])
+    return state
+
+
+def stored_tail_state(stored_df):
+    """
+    Rebuilds the tail state from the last stored bars of a ticker, as written with their indicators.
+    The ATR weights of bars before the tail are left out; they decay by (1 - 1/period) per bar, so a few hundred bars
+    of tail give the same values after rounding.
+    Args:
+    stored_df (DataFrame): Last stored bars in bar order with OHLCV, PREV_* and ROW_NUM_ACS columns.
+    Returns:
+    dict: Tail state for append_technical_indicators.
+    """
+    rows_before = int(stored_df['ROW_NUM_ACS'].iloc[0]) - 1
+    prev = stored_df[PREV_COLUMNS].iloc[0].to_numpy(dtype=numpy.float64).tolist() if rows_before else [numpy.nan] * 5
+    return indicator_tail_state(stored_df[OHLCV_COLUMNS], {"rows": rows_before, "prev": prev, "atr_sums": {}, "volumes": []})
+
+
+def append_technical_indicators(new_ohlc_df, state):
+    """
+    Computes indicators for new bars from the tail state of earlier bars, without recomputing the history.
+    ROW_NUM_DESC and IS_LAST are relative to the new last bar: earlier rows' ROW_NUM_DESC grow by the number of new bars
+    and the previous last row is no longer last. Extremes of the last EXTREME_BAR_COUNT earlier bars can change once
+    later bars exist, so their revised values are returned too.
+    Args:
+    new_ohlc_df (DataFrame): New bars with columns OPEN, CLOSE, HIGH, LOW, VOLUME.
+    state (dict): Tail state from indicator_tail_state or a previous append_technical_indicators call.
+    Returns:
+    tuple: (new bars with indicators, revised EXTREME_LOW/EXTREME_HIGH of earlier bars, updated tail state).
+    """
+    new_ohlc_df = drop_empty_volume_rows(new_ohlc_df)
+    data_length = len(new_ohlc_df)
+    ohlcv = numpy.ascontiguousarray(new_ohlc_df[OHLCV_COLUMNS].to_numpy(dtype=numpy.float64).T)
+    indicator_columns, new_state = compute_indicator_arrays(ohlcv, state)
+
+    columns = {'ROW_NUM_ACS': state["rows"] + numpy.arange(data_length) + 1,
+               'ROW_NUM_DESC': data_length - numpy.arange(data_length)}
+    columns.update(indicator_columns)
+
+    # Extremes over the stored tail plus the new bars; the tail gives every revised and new bar its full left window
+    lows, highs = numpy.concatenate((state["lows"], ohlcv[3])), numpy.concatenate((state["highs"], ohlcv[2]))
+    extreme_lows = extreme_points(lows, EXTREME_BAR_COUNT, "low")
+    extreme_highs = extreme_points(highs, EXTREME_BAR_COUNT, "high")
+    tail_length = len(state["lows"])
+    columns['EXTREME_LOW'], columns['EXTREME_HIGH'] = extreme_lows[tail_length:], extreme_highs[tail_length:]
+    columns['IS_LAST'] = (numpy.arange(data_length) == data_length - 1).astype(numpy.int64)
+
+    revised_count = len(state["index"])
+    revised_extremes = pandas.DataFrame({
+        'EXTREME_LOW': extreme_lows[tail_length - revised_count:tail_length],
+        'EXTREME_HIGH': extreme_highs[tail_length - revised_count:tail_length]}, index=state["index"]).replace(numpy.nan, 0).round(2)
+
+    new_state["lows"] = lows[-2 * EXTREME_BAR_COUNT:].tolist()
+    new_state["highs"] = highs[-2 * EXTREME_BAR_COUNT:].tolist()
+    new_state["index"] = (list(state["index"]) + list(new_ohlc_df.index))[-EXTREME_BAR_COUNT:]
+    return finalize_frame(new_ohlc_df, columns), revised_extremes, new_state
+
+
+def segment_positions(group_keys):
+    """
+    Returns each row's position within its group and the row count of its group, for contiguous groups.
+    """
+    row_count = len(group_keys)
+    is_start = numpy.ones(row_count, dtype=bool)
+    if row_count:
+        is_start[1:] = group_keys[1:] != group_keys[:-1]
+    start_indexes = numpy.flatnonzero(is_start)
+    group_ids = numpy.cumsum(is_start) - 1
+    group_sizes = numpy.diff(numpy.append(start_indexes, row_count))
+    positions = numpy.arange(row_count) - start_indexes[group_ids]
+    return positions, group_sizes[group_ids]
+
+
+def segment_smoothed_moving_average(values, period, positions):
+    """
+    SMMA restarted at every group start: one filter pass over all rows, then the carry-over from the previous group removed.
+    """
+    decay = 1.0 - 1.0 / period
+    weighted_sums = lfilter([1.0], [1.0, -decay], values)
+    # The previous group's final sum leaks into each group and decays along it
+    start_indexes = numpy.arange(len(values)) - positions
+    carry_over = numpy.where(start_indexes > 0, weighted_sums[numpy.maximum(start_indexes - 1, 0)], 0.0)
+    weighted_sums = weighted_sums - carry_over * decay ** (positions + 1)
+    return weighted_sums / ((1.0 - decay ** (positions + 1)) * period)
+
+
+def segment_rolling_mean(values, period, positions):
+    """
+    Rolling mean with min_periods=1 that never reaches back past the group start.
+    """
+    window_sums = values.copy()
+    for lag in range(1, period):
+        window_sums[lag:] += numpy.where(positions[lag:] >= lag, values[:-lag], 0.0)
+    return window_sums / numpy.minimum(positions + 1, period)
+
+
+def add_technical_indicators_batch(prices_df, group_column='TICKER'):
+    """
+    Extends a long-format OHLC dataframe covering many tickers with the same indicators as add_technical_indicators,
+    computed for all tickers in one pass. Shifts, averages and extremes restart at every ticker.
+    Args:
+    prices_df (DataFrame): Stacked per-ticker frames with columns TICKER, OPEN, CLOSE, HIGH, LOW, VOLUME in bar order.
+    group_column (str): Column identifying the series.
+    Returns:
+    DataFrame: Stacked result grouped by ticker in first-appearance order, ready to write.
+    """
+    # Handle Volume zero values and NaNs, then make every ticker's rows contiguous keeping their bar order
+    prices_df = drop_empty_volume_rows(prices_df)
+    group_codes = pandas.factorize(prices_df[group_column])[0]
+    if len(group_codes) and (numpy.diff(group_codes) < 0).any():
+        prices_df = prices_df.iloc[numpy.argsort(group_codes, kind='stable')]
+        group_codes = pandas.factorize(prices_df[group_column])[0]
+    positions, group_sizes = segment_positions(group_codes)
+    is_first = positions == 0
+
+    ohlcv = numpy.ascontiguousarray(prices_df[OHLCV_COLUMNS].to_numpy(dtype=numpy.float64).T)
+    open_, close, high, low, volume = ohlcv
+
+    prev = numpy.full_like(ohlcv, numpy.nan)
+    prev[:, 1:] = ohlcv[:, :-1]
+    prev[:, is_first] = numpy.nan
+    prev_close = prev[1]
+
+    columns = {'ROW_NUM_ACS': positions + 1, 'ROW_NUM_DESC': group_sizes - positions}
+    columns.update({name: prev[i] for i, name in enumerate(PREV_COLUMNS)})
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        columns['CHANGE_OPEN_PRICE'] = open_ - prev_close
+        columns['CHANGE_OPEN_PERCENT'] = columns['CHANGE_OPEN_PRICE'] / close * 100
+        columns['CHANGE_PRICE'] = close - prev_close
+        columns['CHANGE_PERCENT'] = columns['CHANGE_PRICE'] / prev_close * 100
+    columns['TR'] = high - low
+
+    atr_prev_close = numpy.where(is_first, close, prev_close)
+    true_range = numpy.maximum(high - low, numpy.maximum(numpy.abs(high - atr_prev_close), numpy.abs(low - atr_prev_close)))
+    true_range = numpy.nan_to_num(true_range)
+    for period in ATR_PERIODS:
+        columns[f'ATR_{period}'] = segment_smoothed_moving_average(true_range, period, positions)
+    for period in VOLUME_AVG_PERIODS:
+        columns[f'VOL_AVG_{period}'] = numpy.round(segment_rolling_mean(volume, period, positions), 0)
+
+    # Find Extremes Points
+    columns['EXTREME_LOW'] = segment_extreme_points(low, group_sizes[positions == 0], EXTREME_BAR_COUNT, "low")
+    columns['EXTREME_HIGH'] = segment_extreme_points(high, group_sizes[positions == 0], EXTREME_BAR_COUNT, "high")
+
+    # Mark Last Row of every ticker
+    columns['IS_LAST'] = (positions == group_sizes - 1).astype(numpy.int64)
+
+    return finalize_frame(prices_df, columns)
+
+
+def benchmark_technical_indicators(ticker_count=2000, bar_count=500, seed=0):
+    """
+    Times add_technical_indicators per ticker and add_technical_indicators_batch over the same synthetic random-walk
+    tickers and prints tickers/sec for both.
+    """
+    rng = numpy.random.default_rng(seed)
+    frames = []
+    for ticker_number in range(ticker_count):
+        close = 100 + numpy.cumsum(rng.normal(0, 1, bar_count))
+        spread = numpy.abs(rng.normal(0, 0.5, bar_count))
+        frames.append(pandas.DataFrame({'TICKER': f'T{ticker_number}', 'OPEN': close + rng.normal(0, 0.2, bar_count),
+                                        'HIGH': close + spread, 'LOW': close - spread, 'CLOSE': close,
+                                        'VOLUME': rng.integers(1, 1_000_000, bar_count).astype(numpy.float64)}))
+    start_time = time.perf_counter()
+    for frame in frames:
+        add_technical_indicators(frame)
+    elapsed = time.perf_counter() - start_time
+    print(f"Per ticker: {ticker_count} tickers x {bar_count} bars: {elapsed:.2f}s ({ticker_count / elapsed:.0f} tickers/sec)")
+
+    prices_df = pandas.concat(frames, ignore_index=True)
+    start_time = time.perf_counter()
+    add_technical_indicators_batch(prices_df)
+    batch_elapsed = time.perf_counter() - start_time
+    print(f"Batch: {ticker_count} tickers x {bar_count} bars: {batch_elapsed:.2f}s ({ticker_count / batch_elapsed:.0f} tickers/sec)")
+    return elapsed, batch_elapsed
 
-    # Finalize DataFrame
-    ohlc_df = ohlc_df.replace(numpy.nan, 0).round(2)
 
-    return ohlc_df
+if __name__ == "__main__":
+    benchmark_technical_indicators()
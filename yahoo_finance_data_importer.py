@@ -1,13 +1,88 @@
-﻿from datetime import datetime
+﻿import os
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty, Full, Queue
+import cx_Oracle
+import numpy as np
 import pandas as pd
 import yfinance as yf
 from tqdm import tqdm
 import oracle_connect
-from technical_indicators import add_technical_indicators
+from ohlc_cache import OhlcCache
+from technical_indicators import add_technical_indicators_batch, append_technical_indicators, stored_tail_state
 
 # Author: Ruslana Kruk 2022
 # This module imports stock data from Yahoo Finance for database tickers and stores it in database.
 
+# DataFrame columns and the PRICES columns they are written to
+prices_columns = [('TICKER', 'SYMBOL'), ('INTERVAL', 'INTERVAL'), ('DATE_TIME', 'Interval_Date_Time'), ('OPEN', 'OPEN'),
+                  ('HIGH', 'High'), ('LOW', 'Low'), ('CLOSE', 'CLOSE'), ('VOLUME', 'Volume'), ('ROW_NUM_ACS', 'Row_num_Asc'),
+                  ('ROW_NUM_DESC', 'Row_num_Desc'), ('PREV_OPEN', 'Prev_Open'), ('PREV_CLOSE', 'Prev_Close'),
+                  ('PREV_HIGH', 'Prev_High'), ('PREV_LOW', 'Prev_Low'), ('PREV_VOLUME', 'Prev_Volume'),
+                  ('CHANGE_OPEN_PRICE', 'Change_Open_Price'), ('CHANGE_OPEN_PERCENT', 'Change_Open_Percent'),
+                  ('CHANGE_PRICE', 'Change_Price'), ('CHANGE_PERCENT', 'Change_Percent'), ('TR', 'Ti_Tr'),
+                  ('ATR_5', 'Ti_Atr_5'), ('ATR_12', 'Ti_Atr_12'), ('ATR_24', 'Ti_Atr_24'), ('VOL_AVG_5', 'VOL_AVG_5'),
+                  ('VOL_AVG_12', 'VOL_AVG_12'), ('VOL_AVG_24', 'VOL_AVG_24'), ('IS_LAST', 'Is_Last'),
+                  ('EXTREME_LOW', 'EXTREME_LOW'), ('EXTREME_HIGH', 'EXTREME_HIGH')]
+prices_text_columns = ['TICKER', 'INTERVAL']
+prices_date_columns = ['DATE_TIME']
+
+# Partition writes go through a session-private staging table; rows per PL/SQL array bind
+prices_staging_table = "PRICES_STG"
+array_bind_size = 50000
+
+# Pipeline settings: partitions queued between stages and processes computing indicators
+pipeline_queue_size = 2
+compute_processes = 2
+
+# Incremental refresh: stored bars read per ticker to rebuild the indicator state, earlier bars re-downloaded to detect
+# corrections such as splits, and the largest price difference accepted for the 2-decimal stored prices
+tail_bars = 500
+overlap_bars = 5
+price_tolerance = 0.01
+# Oracle allows at most 1000 expressions in an IN list (ORA-01795)
+in_list_limit = 1000
+stored_columns = ['TICKER', 'DATE_TIME', 'OPEN', 'HIGH', 'LOW', 'CLOSE', 'VOLUME', 'ROW_NUM_ACS',
+                  'PREV_OPEN', 'PREV_CLOSE', 'PREV_HIGH', 'PREV_LOW', 'PREV_VOLUME']
+
+# Write modes: replace all rows of the partition's tickers, or merge bars by date
+write_mode_replace = "replace"
+write_mode_merge = "merge"
+
+prices_column_list = ', '.join([column for _, column in prices_columns])
+prices_sql = {
+    "create_staging": f"CREATE GLOBAL TEMPORARY TABLE {prices_staging_table} ON COMMIT DELETE ROWS "
+                      f"AS SELECT {prices_column_list} FROM PRICES WHERE 1 = 0",
+    # One round trip per chunk: every column is bound as a PL/SQL index-by table and inserted with FORALL
+    "load_staging": f"""
+        BEGIN
+            FORALL i IN 1 .. :row_count
+                INSERT INTO {prices_staging_table} ({prices_column_list})
+                VALUES ({', '.join([f':c{position}(i)' for position in range(len(prices_columns))])});
+        END;""",
+    "delete_replaced": f"DELETE /*+NOLOGGING*/ FROM PRICES t WHERE t.Interval = :interval "
+                       f"AND t.SYMBOL IN (SELECT DISTINCT s.SYMBOL FROM {prices_staging_table} s)",
+    # Conventional insert: a direct-path APPEND would need an exclusive PRICES lock while parallel writers
+    # hold row locks from their DELETE, which deadlocks (ORA-00060)
+    "insert_from_staging": f"INSERT INTO PRICES ({prices_column_list}) "
+                           f"SELECT {prices_column_list} FROM {prices_staging_table}",
+    "merge_from_staging": f"""
+        MERGE INTO PRICES dst
+        USING (SELECT {prices_column_list} FROM {prices_staging_table}) src
+        ON (dst.SYMBOL = src.SYMBOL AND dst.INTERVAL = src.INTERVAL AND dst.Interval_Date_Time = src.Interval_Date_Time)
+        WHEN MATCHED THEN
+            UPDATE SET {', '.join([f'dst.{column} = src.{column}' for _, column in prices_columns[3:]])}
+        WHEN NOT MATCHED THEN
+            INSERT ({prices_column_list})
+            VALUES ({', '.join([f'src.{column}' for _, column in prices_columns])})""",
+    "shift_row_num_desc": "UPDATE PRICES t SET t.Row_num_Desc = t.Row_num_Desc + :shift, t.Is_Last = 0 "
+                          "WHERE t.SYMBOL = :ticker AND t.Interval = :interval AND t.Interval_Date_Time < :last_date",
+    "revise_extremes": "UPDATE PRICES t SET t.EXTREME_LOW = :extreme_low, t.EXTREME_HIGH = :extreme_high "
+                       "WHERE t.SYMBOL = :ticker AND t.Interval = :interval AND t.Interval_Date_Time = :bar_date",
+}
+
 def read_tickers_from_database(connection, partition_size, query):
     print(f"{datetime.now().time()} - Import Stocks - Start load Tickers")
     ora_cursor = connection.cursor()
@@ -26,8 +101,48 @@ def read_tickers_from_database(connection, partition_size, query):
     print(f"{datetime.now().time()} - Import Stocks - End Tickers load. Loaded - {ticker_count}. Parts - {len(ticker_parts)} by {partition_size} per part.")
     return ticker_parts
 
-def read_prices_from_yahoo(tickers, period, interval):
-    ticker_prices = yf.download(tickers, period=period, interval=interval, group_by='ticker', auto_adjust=False, prepost=False, threads=True).T
+def read_prices_from_yahoo(tickers, period, interval, start=None):
+    download_range = {'start': start} if start is not None else {'period': period}
+    ticker_prices = yf.download(tickers, interval=interval, group_by='ticker', auto_adjust=False, prepost=False, threads=True, **download_range)
+    return split_yahoo_prices(ticker_prices, tickers, interval)
+
+# Gather a wide (ticker, field) column frame from yf.download into one contiguous tickers x bars x OHLCV block,
+# with a mask of the bars that have any price. Tickers missing from the frame are left out.
+def yahoo_price_blocks(ticker_prices, tickers):
+    fields = ['Open', 'High', 'Low', 'Close', 'Volume']
+    tickers = [ticker for ticker in tickers if ticker in ticker_prices.columns.get_level_values(0)]
+    positions = ticker_prices.columns.get_indexer(pd.MultiIndex.from_product([tickers, fields]))
+    blocks = ticker_prices.to_numpy(dtype=np.float64)[:, positions].reshape(len(ticker_prices), len(tickers), len(fields))
+    blocks = np.ascontiguousarray(blocks.transpose(1, 0, 2))
+    return tickers, blocks, ~np.isnan(blocks).all(axis=2)
+
+# Split a yf.download frame into per-ticker frames without transposes; bars without prices and tickers without bars are dropped
+def split_yahoo_prices(ticker_prices, tickers, interval):
+    tickers, blocks, has_bar = yahoo_price_blocks(ticker_prices, tickers)
+    dates = ticker_prices.index.tz_localize(None)
+
+    tickers_prices = []
+    for ticker, block, bar_rows in zip(tickers, blocks, has_bar):
+        if not bar_rows.any():
+            continue
+        bars = block[bar_rows]
+        tickers_prices.append(pd.DataFrame({'TICKER': ticker, 'INTERVAL': interval, 'DATE_TIME': dates[bar_rows],
+                                            'OPEN': bars[:, 0], 'HIGH': bars[:, 1], 'LOW': bars[:, 2], 'CLOSE': bars[:, 3],
+                                            'VOLUME': bars[:, 4]}, index=ticker_prices.index[bar_rows]))
+    return tickers_prices
+
+# Reshape a yf.download frame once into the stacked long format used by add_technical_indicators_batch
+def yahoo_prices_to_long(ticker_prices, tickers, interval):
+    tickers, blocks, has_bar = yahoo_price_blocks(ticker_prices, tickers)
+    bar_rows = has_bar.ravel()
+    bars = blocks.reshape(-1, blocks.shape[2])[bar_rows]
+    return pd.DataFrame({'TICKER': np.repeat(np.array(tickers, dtype=object), len(ticker_prices))[bar_rows], 'INTERVAL': interval,
+                         'DATE_TIME': np.tile(ticker_prices.index.tz_localize(None).to_numpy(), len(tickers))[bar_rows],
+                         'OPEN': bars[:, 0], 'HIGH': bars[:, 1], 'LOW': bars[:, 2], 'CLOSE': bars[:, 3], 'VOLUME': bars[:, 4]})
+
+# Previous splitter with per-ticker transposes, kept as the baseline for benchmark_yahoo_split
+def split_yahoo_prices_transposed(ticker_prices, tickers, interval):
+    ticker_prices = ticker_prices.T
     ticker_prices.sort_index(inplace=True)
 
     tickers_prices = []
@@ -43,6 +158,53 @@ def read_prices_from_yahoo(tickers, period, interval):
 
     return tickers_prices
 
+# Time both splitters on a synthetic wide frame shaped like yf.download(group_by='ticker') output
+def benchmark_yahoo_split(ticker_count=500, bar_count=1000, empty_tickers=25, seed=0):
+    rng = np.random.default_rng(seed)
+    tickers = [f"T{ticker_number}" for ticker_number in range(ticker_count)]
+    columns = pd.MultiIndex.from_product([tickers, ['Adj Close', 'Close', 'High', 'Low', 'Open', 'Volume']], names=['Ticker', 'Price'])
+    values = 100 + rng.normal(0, 1, (bar_count, len(columns))).cumsum(axis=0)
+    values[:, :empty_tickers * 6] = np.nan
+    values[:bar_count // 2, empty_tickers * 6:empty_tickers * 12] = np.nan
+    ticker_prices = pd.DataFrame(values, columns=columns,
+                                 index=pd.date_range('2020-01-01', periods=bar_count, freq='h', tz='America/New_York', name='Datetime'))
+
+    for split in (split_yahoo_prices_transposed, split_yahoo_prices):
+        start_time = time.perf_counter()
+        tickers_prices = split(ticker_prices, tickers, '1h')
+        print(f"{split.__name__}: {ticker_count} tickers x {bar_count} bars in {time.perf_counter() - start_time:.2f}s, "
+              f"{len(tickers_prices)} frames, {sum(len(ticker_df) for ticker_df in tickers_prices)} rows")
+    start_time = time.perf_counter()
+    prices_df = yahoo_prices_to_long(ticker_prices, tickers, '1h')
+    print(f"yahoo_prices_to_long: {ticker_count} tickers x {bar_count} bars in {time.perf_counter() - start_time:.2f}s, {len(prices_df)} rows")
+
+# Offline data source reading <ticker>_<interval>.csv files written by save_price_fixtures; missing tickers are skipped
+def fixture_data_source(directory):
+    def read_prices_from_fixtures(tickers, period, interval, start=None):
+        tickers_prices = []
+        for ticker in tickers:
+            path = os.path.join(directory, f"{ticker}_{interval}.csv")
+            if os.path.exists(path):
+                ticker_df = pd.read_csv(path, parse_dates=['DATE_TIME'])
+                tickers_prices.append(ticker_df if start is None else ticker_df[ticker_df['DATE_TIME'] >= start])
+        return tickers_prices
+    return read_prices_from_fixtures
+
+# Data source backed by the local OHLC cache: only bars newer than the cached ones are downloaded,
+# with offline=True the cache alone is read
+def cached_data_source(directory, data_source=read_prices_from_yahoo, offline=False):
+    cache = OhlcCache(directory)
+    def read_prices_from_cache(tickers, period, interval, start=None):
+        tickers_prices = cache.cached_download(tickers, period, interval, data_source, offline)
+        return tickers_prices if start is None else [ticker_df[ticker_df['DATE_TIME'] >= start] for ticker_df in tickers_prices]
+    return read_prices_from_cache
+
+# Save downloaded prices as fixture files for fixture_data_source
+def save_price_fixtures(tickers, period, interval, directory, data_source=read_prices_from_yahoo):
+    os.makedirs(directory, exist_ok=True)
+    for ticker_df in data_source(tickers, period, interval):
+        ticker_df.to_csv(os.path.join(directory, f"{ticker_df['TICKER'].iloc[0]}_{interval}.csv"), index=False)
+
 def delete_ohlc_from_database(connection, ticker, interval):
     cur_delete = connection.cursor()
     cur_delete.execute("DELETE /*+NOLOGGING*/ FROM PRICES t WHERE t.SYMBOL = :ticker AND t.Interval = :interval", [ticker, interval])
@@ -61,18 +223,313 @@ def write_ohlc_to_database(connection, ohlc_df):
     cur_write.close()
     connection.commit()
 
-# Example function for one of the data worker types
-def stock_data_worker(interval, period, partition_size, query):
+# Create the staging table unless it already exists (ORA-00955)
+def ensure_prices_staging_table(connection):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(prices_sql["create_staging"])
+    except cx_Oracle.DatabaseError as e:
+        error, = e.args
+        if error.code != 955:
+            raise
+    finally:
+        cursor.close()
+
+# Column arrays for binding: numbers as float64 arrays, dates and text as Python lists, no per-row tuples
+def prices_bind_columns(ohlc_df):
+    bind_columns = []
+    for df_column, _ in prices_columns:
+        if df_column in prices_text_columns:
+            bind_columns.append((str, ohlc_df[df_column].astype(str).tolist()))
+        elif df_column in prices_date_columns:
+            bind_columns.append((cx_Oracle.DATETIME, pd.to_datetime(ohlc_df[df_column]).tolist()))
+        else:
+            bind_columns.append((cx_Oracle.NATIVE_FLOAT, ohlc_df[df_column].to_numpy(dtype=np.float64)))
+    return bind_columns
+
+# Load the column arrays into the staging table in chunks of array_bind_size rows
+def load_prices_staging(cursor, bind_columns, row_count):
+    for start in range(0, row_count, array_bind_size):
+        end = min(start + array_bind_size, row_count)
+        binds = {"row_count": end - start}
+        for position, (bind_type, values) in enumerate(bind_columns):
+            chunk = values[start:end]
+            if bind_type is str:
+                binds[f"c{position}"] = cursor.arrayvar(str, chunk, max(map(len, chunk)))
+            else:
+                binds[f"c{position}"] = cursor.arrayvar(bind_type, chunk.tolist() if isinstance(chunk, np.ndarray) else chunk)
+        cursor.execute(prices_sql["load_staging"], binds)
+
+# Write a whole partition in one transaction: array-load the staging table, then replace the tickers' rows or merge by bar.
+# Readers see either the old or the new rows of a ticker, never a deleted-but-not-rewritten gap.
+def write_partition_to_database(connection, prices_df, interval, write_mode=write_mode_replace):
+    start_time = time.perf_counter()
+    cursor = connection.cursor()
+    try:
+        load_prices_staging(cursor, prices_bind_columns(prices_df), len(prices_df))
+        if write_mode == write_mode_merge:
+            cursor.execute(prices_sql["merge_from_staging"])
+        else:
+            cursor.execute(prices_sql["delete_replaced"], interval=interval)
+            cursor.execute(prices_sql["insert_from_staging"])
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    return time.perf_counter() - start_time
+
+# Write a partition with a connection from the session pool
+def write_partition_with_pool(session_pool, prices_df, interval, write_mode=write_mode_replace):
+    with session_pool.acquire() as connection:
+        return write_partition_to_database(connection, prices_df, interval, write_mode)
+
+# Read the last tail_bars stored bars of every ticker, as DataFrames indexed by bar date.
+# Tickers are queried in chunks of in_list_limit binds.
+def read_price_tails(connection, tickers, interval):
+    prices_column_names = dict(prices_columns)
+    column_list = ', '.join([prices_column_names[column] for column in stored_columns])
+    rows = []
+    cursor = connection.cursor()
+    try:
+        for chunk_start in range(0, len(tickers), in_list_limit):
+            chunk = tickers[chunk_start:chunk_start + in_list_limit]
+            ticker_binds = ', '.join([f':t{position}' for position in range(len(chunk))])
+            cursor.execute(f"""
+                SELECT {column_list} FROM (
+                    SELECT {column_list}, ROW_NUMBER() OVER (PARTITION BY SYMBOL ORDER BY Interval_Date_Time DESC) AS rn
+                    FROM PRICES WHERE Interval = :interval AND SYMBOL IN ({ticker_binds})
+                ) WHERE rn <= :tail_bars ORDER BY SYMBOL, Interval_Date_Time""",
+                dict(interval=interval, tail_bars=tail_bars, **{f't{position}': ticker for position, ticker in enumerate(chunk)}))
+            rows += cursor.fetchall()
+    finally:
+        cursor.close()
+    stored_df = pd.DataFrame(rows, columns=stored_columns)
+    stored_df.index = pd.to_datetime(stored_df['DATE_TIME'])
+    return {ticker: ticker_df for ticker, ticker_df in stored_df.groupby('TICKER', sort=False)}
+
+# A re-downloaded stored bar with different prices (split, dividend adjustment, data fix) or a missing one means the
+# stored history is stale. The last stored bar is not compared, it may have been written while still forming.
+def prices_corrected(stored_df, ticker_df):
+    compared = stored_df.iloc[-overlap_bars - 1:-1]
+    if stored_df.index[-1] not in ticker_df.index or not compared.index.isin(ticker_df.index).all():
+        return True
+    price_columns = ['OPEN', 'HIGH', 'LOW', 'CLOSE']
+    differences = (ticker_df.loc[compared.index, price_columns].astype(float).round(2) - compared[price_columns].astype(float)).abs()
+    return bool((differences > price_tolerance).to_numpy().any())
+
+# Merge new bars and update the earlier bars they affect in one transaction: Row_num_Desc of earlier bars grows by the
+# number of added bars and the extremes of the last bars before them are revised.
+def upsert_incremental_prices(connection, prices_df, row_num_shifts, revised_extremes):
+    cursor = connection.cursor()
+    try:
+        load_prices_staging(cursor, prices_bind_columns(prices_df), len(prices_df))
+        cursor.execute(prices_sql["merge_from_staging"])
+        if row_num_shifts:
+            cursor.executemany(prices_sql["shift_row_num_desc"], row_num_shifts)
+        if revised_extremes:
+            cursor.executemany(prices_sql["revise_extremes"], revised_extremes)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# Busy seconds, partitions and rows per stage, plus queue depths sampled on every put
+class PipelineStats:
+    def __init__(self, stages):
+        self.lock = threading.Lock()
+        self.stats = {stage: [0, 0, 0.0] for stage in stages}
+        self.queue_depths = {}
+
+    def record(self, stage, rows, seconds):
+        with self.lock:
+            stage_stat = self.stats.setdefault(stage, [0, 0, 0.0])
+            stage_stat[0] += 1
+            stage_stat[1] += rows
+            stage_stat[2] += seconds
+
+    def record_queue_depth(self, queue_name, depth):
+        with self.lock:
+            self.queue_depths.setdefault(queue_name, []).append(depth)
+
+    # Stage with the most busy seconds is the bottleneck; a queue that is usually full feeds a slow stage
+    def report(self):
+        with self.lock:
+            lines = [f"{stage}: {partitions} partitions, {rows} rows, {seconds:.2f}s busy"
+                     for stage, (partitions, rows, seconds) in self.stats.items()]
+            lines += [f"{queue_name} queue: avg depth {sum(depths) / len(depths):.1f}, max {max(depths)}"
+                      for queue_name, depths in self.queue_depths.items()]
+        return "\n".join(lines)
+
+# Put an item into a pipeline queue, giving up once the pipeline has stopped
+def put_unless_stopped(stage_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
+
+# Get an item from a pipeline queue, returning None once the pipeline has stopped
+def get_unless_stopped(stage_queue, stop_event):
+    while not stop_event.is_set():
+        try:
+            return stage_queue.get(timeout=0.1)
+        except Empty:
+            continue
+    return None
+
+# Compute indicators for a partition in a worker process and return the busy time with the result
+def compute_partition(prices_df):
+    start_time = time.perf_counter()
+    return add_technical_indicators_batch(prices_df), time.perf_counter() - start_time
+
+# Example function for one of the data worker types.
+# Partitions flow through three overlapped stages with bounded queues: download (data_source, read_prices_from_yahoo by
+# default), indicator computation in a process pool and Oracle writes. With a session_pool (cx_Oracle.SessionPool)
+# there is one writer per pool session, otherwise a single writer on the worker's connection.
+def stock_data_worker(interval, period, partition_size, query, session_pool=None, data_source=read_prices_from_yahoo,
+                      processes=compute_processes):
+    ora_connection = oracle_connect.connect_to_oracle()
+    ensure_prices_staging_table(ora_connection)
+    tickers_partitions = [tickers for tickers in read_tickers_from_database(ora_connection, partition_size, query) if tickers]
+
+    stats = PipelineStats(["download", "compute", "write"])
+    compute_queue, write_queue = Queue(maxsize=pipeline_queue_size), Queue(maxsize=pipeline_queue_size)
+    stop_event, errors = threading.Event(), []
+    writer_count = session_pool.max if session_pool else 1
+    pbar = tqdm(total=len(tickers_partitions), desc=f'Write {interval} partitions')
+
+    def put_to_stage(stage_queue, queue_name, item):
+        stats.record_queue_depth(queue_name, stage_queue.qsize())
+        return put_unless_stopped(stage_queue, item, stop_event)
+
+    def download_worker():
+        try:
+            for i, tickers in enumerate(tickers_partitions, 1):
+                start_time = time.perf_counter()
+                prices_df = pd.concat(data_source(tickers, period, interval) or [pd.DataFrame()], ignore_index=True)
+                stats.record("download", len(prices_df), time.perf_counter() - start_time)
+                if not put_to_stage(compute_queue, "compute", (i, prices_df)):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            put_unless_stopped(compute_queue, None, stop_event)
+
+    # Submits partitions to the process pool; the bounded write queue limits the partitions in flight
+    def compute_worker(executor):
+        try:
+            while (item := get_unless_stopped(compute_queue, stop_event)) is not None:
+                i, prices_df = item
+                if prices_df.empty:
+                    pbar.update(1)
+                    continue
+                if not put_to_stage(write_queue, "write", (i, executor.submit(compute_partition, prices_df))):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            for _ in range(writer_count):
+                put_unless_stopped(write_queue, None, stop_event)
+
+    def write_worker():
+        try:
+            while (item := get_unless_stopped(write_queue, stop_event)) is not None:
+                i, future = item
+                prices_df, compute_seconds = future.result()
+                stats.record("compute", len(prices_df), compute_seconds)
+                if session_pool:
+                    seconds = write_partition_with_pool(session_pool, prices_df, interval)
+                else:
+                    seconds = write_partition_to_database(ora_connection, prices_df, interval)
+                stats.record("write", len(prices_df), seconds)
+                pbar.update(1)
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            workers = [threading.Thread(target=download_worker), threading.Thread(target=compute_worker, args=(executor,))] + \
+                      [threading.Thread(target=write_worker) for _ in range(writer_count)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+    finally:
+        pbar.close()
+        ora_connection.close()
+
+    if errors:
+        raise errors[0]
+    print(f"{datetime.now().time()} - Import Stocks - {interval} pipeline stages:\n{stats.report()}")
+
+# Refresh one partition incrementally: for tickers with stored bars, download from a few bars before the last stored
+# bar, recompute indicators from the stored tail state for the last stored bar onwards and upsert only those bars.
+# Tickers are downloaded in groups with the same start, so one stale ticker does not widen the window of the others.
+# Tickers without stored bars, with corrected history or missing from the download are reloaded in full.
+def refresh_partition(connection, tickers, period, interval, data_source=read_prices_from_yahoo):
+    tails = {ticker: stored_df for ticker, stored_df in read_price_tails(connection, tickers, interval).items() if len(stored_df) > 1}
+    full_tickers = [ticker for ticker in tickers if ticker not in tails]
+    new_bars, row_num_shifts, revised_extremes = [], [], []
+
+    start_groups = {}
+    for ticker, stored_df in tails.items():
+        start_groups.setdefault(stored_df.index[max(0, len(stored_df) - overlap_bars - 1)], []).append(ticker)
+    downloaded_tickers = set()
+    for start, group_tickers in start_groups.items():
+        for ticker_df in data_source(group_tickers, period, interval, start=start):
+            ticker_df = ticker_df.dropna(subset=['CLOSE'])
+            if ticker_df.empty:
+                continue
+            ticker = ticker_df['TICKER'].iloc[0]
+            downloaded_tickers.add(ticker)
+            stored_df = tails[ticker]
+            ticker_df = ticker_df.set_index(pd.to_datetime(ticker_df['DATE_TIME']).rename(None))
+            if prices_corrected(stored_df, ticker_df):
+                full_tickers.append(ticker)
+                continue
+
+            last_date = stored_df.index[-1]
+            ticker_bars, revised, _ = append_technical_indicators(ticker_df[ticker_df.index >= last_date], stored_tail_state(stored_df.iloc[:-1]))
+            new_bars.append(ticker_bars)
+            row_num_shifts.append(dict(shift=len(ticker_bars) - 1, ticker=ticker, interval=interval, last_date=last_date.to_pydatetime()))
+            revised_extremes += [dict(extreme_low=row.EXTREME_LOW, extreme_high=row.EXTREME_HIGH, ticker=ticker, interval=interval,
+                                      bar_date=bar_date.to_pydatetime()) for bar_date, row in revised.iterrows()]
+
+    missing_tickers = [ticker for ticker in tails if ticker not in downloaded_tickers]
+    if missing_tickers:
+        print(f"{datetime.now().time()} - Refresh {interval}: no bars downloaded for {', '.join(missing_tickers)}, reloading in full")
+        full_tickers += missing_tickers
+
+    if new_bars:
+        upsert_incremental_prices(connection, pd.concat(new_bars, ignore_index=True), row_num_shifts, revised_extremes)
+    if full_tickers:
+        full_prices = data_source(full_tickers, period, interval)
+        if full_prices:
+            write_partition_to_database(connection, add_technical_indicators_batch(pd.concat(full_prices, ignore_index=True)), interval)
+    return sum(len(ticker_bars) for ticker_bars in new_bars), full_tickers
+
+# Incremental variant of stock_data_worker: only the bars after the last stored bar are downloaded and written
+def stock_data_refresh_worker(interval, period, partition_size, query, data_source=read_prices_from_yahoo):
     ora_connection = oracle_connect.connect_to_oracle()
-    tickers_partitions = read_tickers_from_database(ora_connection, partition_size, query)
-    for i, tickers in enumerate(tickers_partitions, 1):
-        print(f'\nWork on {i}/{len(tickers_partitions)} partition. Start {interval} timeframe')
-        df = read_prices_from_yahoo(tickers, period, interval)
-        pbar = tqdm(df)
-        for x in pbar:
-            current_ticker = x['TICKER'].iloc[0]
-            df_ti = add_technical_indicators(x)
-            delete_ohlc_from_database(ora_connection, current_ticker, interval)
-            write_ohlc_to_database(ora_connection, df_ti)
-            pbar.set_description('Write to database')
+    ensure_prices_staging_table(ora_connection)
+    tickers_partitions = [tickers for tickers in read_tickers_from_database(ora_connection, partition_size, query) if tickers]
+    try:
+        for i, tickers in enumerate(tqdm(tickers_partitions, desc=f'Refresh {interval} partitions'), 1):
+            start_time = time.perf_counter()
+            bar_count, full_tickers = refresh_partition(ora_connection, tickers, period, interval, data_source)
+            print(f"{datetime.now().time()} - Partition {i}: {bar_count} bars upserted, {len(full_tickers)} tickers reloaded "
+                  f"in {time.perf_counter() - start_time:.2f}s")
+    finally:
+        ora_connection.close()
 
+if __name__ == "__main__":
+    benchmark_yahoo_split()